@@ -7,116 +7,340 @@ import os
 import sys
 import traceback
 
-from collections import defaultdict
+from contextlib import nullcontext
 
-from . import mailproc
-from .osso_ez_rmq import BaseProducer, rmq_uri
-from .settings import PUBLISH_API
+from . import mailproc, sources, suppress
+from .delayed import DelayedIndex
+from .pipe import emlbounce2pipe
+from .publish import EXIT_PUBLISH_FAILED, publish_invalids
+from .spool import Spool
+from .tracelog import TraceLog
 
 
 log = logging.getLogger('emlbounce2rmq')
 
+EXIT_QUARANTINED = 3  # some files were quarantined, the rest was processed
 
-class Publisher(BaseProducer):
-    def __init__(self):
-        self._rmqc = rmq_uri(PUBLISH_API)
-        log.debug('Setting up RabbitMQ connection from URI: %s', self._rmqc)
-        super().__init__()
 
+def export_suppression(invalids, path, expire_days):
+    count = suppress.update_table(path, invalids, expire_days)
+    log.info('Summary of suppression table: %d entries in %s', count, path)
 
-def emlbounce2rmq(filenames, do_move, do_publish):
+
+def escalate_delayed(delayed, invalids, escalate_days, expire_days):
+    escalated = delayed.expire(escalate_days, expire_days)
+    for record in escalated:
+        log.info(
+            '%s: Delayed for %d+ days, marked as invalid-destination '
+            '(rcpt = %s)', record.filename, escalate_days, record.recipient)
+        invalids.add(record)
+    return escalated
+
+
+def publish(invalids, do_publish, rollup_domains=0, delayed=None,
+            escalated=()):
+    """
+    Publish the invalids. The ones that could not be published are removed
+    from invalids, so they are not moved or exported, and returned. The
+    escalated delays are resolved only once published.
+    """
+    failed = []
+    if invalids:
+        failed = publish_invalids(invalids, do_publish, rollup_domains)
+    for efile in failed:
+        invalids.remove(efile)
+    unpublished = set(failed)
+    for record in escalated:
+        if record not in unpublished:
+            delayed.resolve(record.envelope_from, record.recipient)
+    return failed
+
+
+def quarantine(filename, error, do_move, movable):
+    log.warning(
+        '%s - %s: Moving to .Quarantine (%s)',
+        filename, error.__class__.__name__, error)
+    if do_move and movable:
+        try:
+            mailproc.quarantine_email(filename, error)
+        except Exception:
+            log.exception(
+                '%s: Quarantine failed, leaving in place', filename)
+
+
+def classify(efile, dedup, dispatcher, invalids, delayed=None):
+    """
+    Run the handlers over efile (adding it to invalids if needed). Returns
+    the response and the folder to move to (None for invalids, which are
+    moved in bulk). Anything other than a classification is raised.
+    """
+    try:
+        dispatcher.dispatch(efile)
+    except mailproc.Email2xx as e:
+        log.debug(
+            '%s - %s: Moving to .Junk.Autoreply (subj = %s)',
+            efile.filename, e.__class__.__name__, efile.get_subject())
+        return e, '.Junk-Autoreply'
+    except mailproc.Email299 as e:
+        log.debug(
+            '%s - %s: Moving to .Junk.Checkme (subj = %s)',
+            efile.filename, e.__class__.__name__, efile.get_subject())
+        return e, '.Junk-Checkme'
+    except mailproc.Email4xx as e:
+        # A 4xx means that it will be retried, and we'll get a 5xx
+        # later on. Drop the mail?
+        log.debug(
+            '%s - %s: Keeping. Should be deleted! (rcpt = %s)',
+            efile.filename, e.__class__.__name__, e.final_rcpt)
+        if delayed is not None:
+            delayed.add(efile, e.final_rcpt)
+        return e, '.Junk-Deleted'
+    except mailproc.Email5xx as e:
+        if dedup.is_duplicate_recipient(efile, e.final_rcpt):
+            log.debug(
+                '%s - %s: Duplicate, moving to .Junk-Deleted (rcpt = %s)',
+                efile.filename, e.__class__.__name__, e.final_rcpt)
+            return e, '.Junk-Deleted'
+        log.debug(
+            '%s - %s: Marked as invalid-destination (rcpt = %s)',
+            efile.filename, e.__class__.__name__, e.final_rcpt)
+        invalids.add(efile)
+        if delayed is not None:
+            delayed.resolve(efile.get_original_envelope_from(), e.final_rcpt)
+        return e, None
+
+
+def emlbounce2rmq(filenames, do_move, do_publish, rollup_domains=0,
+                  suppression_table=None, suppression_days=180,
+                  delayed=None, delayed_days=(4, 2), tracelog=None):
+    """
+    Process all filenames. Returns the number of quarantined files and the
+    number of invalids that could not be published; those are left in
+    place for the next run.
+
+    If a DelayedIndex is passed, 4xx mails are recorded there (and skipped
+    on the next run, if they're still there), and delays that lasted
+    delayed_days[0] days (escalate) are published as invalid. Delays are
+    dropped after no news for delayed_days[1] days (expire).
+    """
     # Collect totals.
     parser = mailproc.MailParser()
     invalids = mailproc.InvalidAddressCollector()
-    handlers_count = defaultdict(int)
-    for filename in filenames:
-        with open(filename, 'rb') as fp:
-            stat = os.fstat(fp.fileno())
-            parsed = parser.parse(fp)
-        efile = mailproc.EmailFile(filename, stat, parsed)
+    dedup = mailproc.DuplicateIndex()
+    dispatcher = mailproc.HandlerDispatcher()
+    tracelog = tracelog or TraceLog(slowest=0)
+    quarantined = delayed_skipped = 0
+    for message in sources.iter_messages(filenames):
+        # Only maildir files are recorded as seen; archive and mbox members
+        # share their basenames with the files they were made from.
+        if (delayed is not None and message.movable and
+                delayed.is_seen(message.filename)):
+            delayed_skipped += 1
+            continue
+
+        # Isolate failures: one odd mail should not throw away the work done
+        # on all the others.
+        trace = tracelog.start(message.filename)
+        data = b''
+        efile = None
         try:
-            for handler in mailproc.handlers:
-                handler(efile)
-            handler = None
-        except mailproc.Email2xx as e:
-            log.debug(
-                '%s - %s: Moving to .Junk.Autoreply (subj = %s)',
-                efile.filename, e.__class__.__name__, efile.get_subject())
-            if do_move:
-                mailproc.move_email(efile.filename, '.Junk-Autoreply')
-        except mailproc.Email299 as e:
-            log.debug(
-                '%s - %s: Moving to .Junk.Checkme (subj = %s)',
-                efile.filename, e.__class__.__name__)
-            if do_move:
-                mailproc.move_email(efile.filename, '.Junk-Checkme')
-        except mailproc.Email4xx as e:
-            # A 4xx means that it will be retried, and we'll get a 5xx
-            # later on. Drop the mail?
-            log.debug(
-                '%s - %s: Keeping. Should be deleted! (rcpt = %s)',
-                efile.filename, e.__class__.__name__, e.final_rcpt)
-            if do_move:
-                mailproc.move_email(efile.filename, '.Junk-Deleted')
-        except mailproc.Email5xx as e:
-            log.debug(
-                '%s - %s: Marked as invalid-destination (rcpt = %s)',
-                efile.filename, e.__class__.__name__, e.final_rcpt)
-            invalids.add(efile)
-        else:
-            raise NotImplementedError(
-                'programming error on: {fn}'.format(fn=efile.filename))
-        finally:
-            handlers_count[handler.__name__] += 1
+            if message.error:
+                raise message.error
+            data = message.fp.read()
+            trace.lap('read')
+            # Exact copies are recognised before the full parse.
+            try:
+                dedup.skip_duplicate(message.filename, data)
+                duplicate = None
+            except mailproc.DuplicateEmail as e:
+                duplicate = e
+            trace.lap('dedup')
+            if duplicate:
+                log.debug(
+                    '%s - %s: Moving to .Junk-Deleted',
+                    message.filename, duplicate.__class__.__name__)
+                response, new_folder = duplicate, '.Junk-Deleted'
+            else:
+                parsed = parser.parsebytes(data)
+                trace.lap('parse')
+                efile = mailproc.EmailFile(
+                    message.filename, message.stat, parsed,
+                    movable=message.movable)
+                response, new_folder = classify(
+                    efile, dedup, dispatcher, invalids, delayed)
+                trace.lap('classify')
+            if new_folder and do_move and message.movable:
+                mailproc.move_email(message.filename, new_folder)
+            trace.lap('move')
+        except Exception as e:
+            trace.lap('failed')
+            response = e
+            quarantined += 1
+            quarantine(message.filename, e, do_move, message.movable)
+            trace.lap('quarantine')
+        tracelog.finish(trace, len(data), efile, response)
+
+    # Delays that lasted too long count as invalid recipients:
+    escalated = []
+    if delayed is not None:
+        escalated = escalate_delayed(delayed, invalids, *delayed_days)
 
     # Time for a summary:
-    if invalids:
-        if do_publish:
-            publisher = Publisher()
-            for invalid in invalids:
-                doc = invalid.as_dict()
-                log.debug('publish: %r', doc)
-                publisher.publish(doc)
-            publisher.close()
-        else:
-            for invalid in invalids:
-                doc = invalid.as_dict()
-                log.info('Summary of bad RCPT: %s', invalid)
-
-        # Move to .Bad-Recipient/
-        if do_move:
-            # NOTE: We'll want to purge these from the disk at one point.
-            # Use a cron job with find for now.
-            #   find .../bounces -mtime +180 -regex '.*/[0-9]+[.].*' -type f \
-            #     -delete
-            invalids.move_all_to('.Bad-Recipient')
+    unpublished = publish(
+        invalids, do_publish, rollup_domains, delayed, escalated)
+    if delayed is not None:
+        log.info(
+            'Summary of delayed recipients: %d pending, %d files skipped',
+            len(delayed), delayed_skipped)
+    if suppression_table:
+        # Also without invalids, so old entries expire.
+        export_suppression(invalids, suppression_table, suppression_days)
+
+    # Move to .Bad-Recipient/
+    if invalids and do_move:
+        # NOTE: These are archived and purged by the archive module,
+        # see: python3 -m emlbounce2rmq.archive --help
+        for efile, e in invalids.move_all_to('.Bad-Recipient'):
+            quarantined += 1
+            quarantine(efile.filename, e, do_move, efile.movable)
+
+    if dedup.duplicates:
+        log.info('Summary of duplicate bounces: %d skipped', dedup.duplicates)
+
+    # Report layouts that no handler understood, one example each:
+    for signature, unknown in sorted(
+            dispatcher.unknown.items(), key=(lambda x: -len(x[1]))):
+        log.warning(
+            'Summary of unknown bounce format: %dx, e.g. %s %r',
+            len(unknown), unknown[0], signature)
 
     # Debug what handlers were used:
-    if len(handlers_count):
-        for key, value in sorted(handlers_count.items()):
+    if len(dispatcher.handlers_count):
+        for key, value in sorted(dispatcher.handlers_count.items()):
             log.debug('Summary of internal handlers: %s = %s', key, value)
 
+    for record in tracelog.report():
+        log.info(
+            'Summary of slowest files: %.1f ms %s (%s)',
+            record['total_ms'], record['path'], record['exception'])
+
+    if quarantined:
+        log.warning('Summary of quarantined files: %d', quarantined)
+    if unpublished:
+        log.error(
+            'Summary of unpublished files: %d, left in place',
+            len(unpublished))
+    return quarantined, len(unpublished)
+
+
+def flush_spool(spool, do_publish, rollup_domains=0, suppression_table=None,
+                suppression_days=180, delayed=None, delayed_days=(4, 2)):
+    """
+    Publish the spooled records. Returns the number that could not be
+    published; those are spooled again, for the next flush.
+    """
+    invalids = mailproc.InvalidAddressCollector()
+    with spool.flushing() as records:
+        for record in records:
+            invalids.add(record)
+        escalated = []
+        if delayed is not None:
+            escalated = escalate_delayed(delayed, invalids, *delayed_days)
+        unpublished = publish(
+            invalids, do_publish, rollup_domains, delayed, escalated)
+        if suppression_table:
+            export_suppression(invalids, suppression_table, suppression_days)
+        # Escalated delays stay in the delayed index instead.
+        escalated = set(escalated)
+        respooled = [i for i in unpublished if i not in escalated]
+        for record in respooled:
+            spool.append(record)
+    log.info(
+        'Summary of spool: %d flushed, %d spooled again',
+        len(records) - len(respooled), len(respooled))
+    return len(unpublished)
+
+
+def delayed_index_or_none(path):
+    if path:
+        return DelayedIndex.loaded(path)
+    return nullcontext()
+
+
+def trace_or_none(path):
+    if path:
+        return open(path, 'a')
+    return nullcontext()
+
 
 def main():
     # Arguments.
     parser = argparse.ArgumentParser(description=(
         'Process EML files, take bounces, output to RabbitMQ. '
         'Maildir format email files should be supplied LF-separated on stdin. '
-        'Or supplied as arguments.'))
+        'Or supplied as arguments. Mbox files (*.mbox) and tar/zip archives '
+        'are read as a whole; their messages are never moved.'))
     parser.add_argument('-n', '--dry-run', action='store_true', help=(
-        'Dry run. Implies --verbose, --no-move and --no-publish.'))
+        'Dry run. Implies --verbose, --no-move and --no-publish, and '
+        'does not write the --suppression-table.'))
     parser.add_argument('-v', '--verbose', action='store_true', help=(
         'Verbose mode.'))
     parser.add_argument('--no-move', action='store_true', help=(
         'Do not move the EML files after processing.'))
     parser.add_argument('--no-publish', action='store_true', help=(
         'Do not publish anything to the RabbitMQ exchange.'))
+    parser.add_argument(
+        '--rollup-domains', type=int, default=0, metavar='N', help=(
+            'Publish a single document per sender and recipient domain '
+            'when N or more recipients of that domain failed.'))
+    parser.add_argument('--suppression-table', metavar='PATH', help=(
+        'Merge the invalid (from, to) pairs into this cdb file, for '
+        'lookups by the outbound MTA.'))
+    parser.add_argument(
+        '--suppression-days', type=int, default=180, metavar='DAYS', help=(
+            'Drop suppression table entries not seen for DAYS days '
+            '(default: 180).'))
+    parser.add_argument('--delayed-index', metavar='PATH', help=(
+        'Keep track of delayed (4xx) recipients in this file. Kept 4xx '
+        'mails are not processed twice.'))
+    parser.add_argument(
+        '--delayed-escalate-days', type=int, default=4, metavar='DAYS',
+        help=(
+            'Treat recipients that are delayed for DAYS days as invalid '
+            '(default: 4).'))
+    parser.add_argument(
+        '--delayed-expire-days', type=int, default=2, metavar='DAYS', help=(
+            'Forget delays without news for DAYS days (default: 2).'))
+    parser.add_argument('--trace', metavar='PATH', help=(
+        'Append a JSON record per file (stage timings, handler, result) '
+        'to PATH.'))
+    parser.add_argument(
+        '--trace-sample', type=float, default=1.0, metavar='RATE', help=(
+            'Only trace this fraction of the files (default: 1.0).'))
+    parser.add_argument(
+        '--trace-slow-ms', type=float, metavar='MS', help=(
+            'Always trace files that took MS milliseconds or more.'))
+    parser.add_argument(
+        '--trace-slowest', type=int, default=10, metavar='N', help=(
+            'Report the N slowest files at the end, with --trace '
+            '(default: 10).'))
+    parser.add_argument('--pipe', action='store_true', help=(
+        'Read a single mail from stdin, for use as a Postfix pipe(8) '
+        'transport. Requires --maildir. Only mails that need keeping are '
+        'written, invalid recipients go to the spool.'))
+    parser.add_argument('--flush-spool', action='store_true', help=(
+        'Publish the invalid recipients collected by --pipe.'))
+    parser.add_argument('--maildir', help=(
+        'Maildir root, holding the .Bad-Recipient etc. folders.'))
+    parser.add_argument('--spool', help=(
+        'Spool file for --pipe (default: MAILDIR/emlbounce2rmq.spool).'))
     parser.add_argument('filenames', nargs='*', help=(
         'EML filenames if not supplied on stdin.'))
     args = parser.parse_args()
 
     if args.dry_run:
         args.no_move = args.no_publish = args.verbose = True
+        args.suppression_table = args.delayed_index = None
 
     # Configure logging.
     logconfig = {
@@ -136,21 +360,65 @@ def main():
     }
     logging.config.dictConfig(logconfig)
 
+    delayed_days = (args.delayed_escalate_days, args.delayed_expire_days)
+
+    if args.pipe or args.flush_spool:
+        if not (args.spool or args.maildir):
+            parser.error('--pipe/--flush-spool require --maildir or --spool')
+        if args.pipe and not args.maildir:
+            parser.error('--pipe requires --maildir')
+        spool = Spool(
+            args.spool or os.path.join(args.maildir, 'emlbounce2rmq.spool'))
+        if args.pipe:
+            try:
+                emlbounce2pipe(
+                    sys.stdin.buffer.read(), args.maildir, spool,
+                    delayed_index=args.delayed_index)
+            except Exception:
+                traceback.print_exc()
+                return os.EX_TEMPFAIL  # let Postfix retry
+        else:
+            with delayed_index_or_none(args.delayed_index) as delayed:
+                unpublished = flush_spool(
+                    spool, do_publish=(not args.no_publish),
+                    rollup_domains=args.rollup_domains,
+                    suppression_table=args.suppression_table,
+                    suppression_days=args.suppression_days,
+                    delayed=delayed, delayed_days=delayed_days)
+            if unpublished:
+                return EXIT_PUBLISH_FAILED
+        return 0
+
     # Accept filenames either on stdin or through argv.
     if args.filenames:
         filenames = args.filenames
     else:
         filenames = map((lambda x: x.rstrip('\n')), iter(sys.stdin))
 
-    emlbounce2rmq(
-        filenames,
-        do_move=(not args.no_move),
-        do_publish=(not args.no_publish))
+    with delayed_index_or_none(args.delayed_index) as delayed, \
+            trace_or_none(args.trace) as trace_fp:
+        tracelog = TraceLog(
+            trace_fp, sample=args.trace_sample, slow_ms=args.trace_slow_ms,
+            slowest=(args.trace_slowest if trace_fp else 0))
+        quarantined, unpublished = emlbounce2rmq(
+            filenames,
+            do_move=(not args.no_move),
+            do_publish=(not args.no_publish),
+            rollup_domains=args.rollup_domains,
+            suppression_table=args.suppression_table,
+            suppression_days=args.suppression_days,
+            delayed=delayed, delayed_days=delayed_days,
+            tracelog=tracelog)
+    if unpublished:
+        return EXIT_PUBLISH_FAILED
+    if quarantined:
+        return EXIT_QUARANTINED
+    return 0
 
 
 if __name__ == '__main__':
     try:
-        main()
+        sys.exit(main())
     except Exception:
         traceback.print_exc()
         sys.exit(255)  # for xargs
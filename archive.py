@@ -0,0 +1,259 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Pack processed bounces into compressed per-day archives, look them up and
+purge them when they expire.
+
+Layout, with one tar.gz and one tab-separated index per folder per day:
+
+    ARCHIVE_DIR/Bad-Recipient/2020/2020-01-02.tar.gz
+    ARCHIVE_DIR/Bad-Recipient/2020/2020-01-02.idx
+
+The index holds: filename, mtime, size, recipient (if known).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tarfile
+import traceback
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from . import mailproc
+
+
+log = logging.getLogger('emlbounce2rmq')
+
+# Not .Junk-Checkme (left for a human to look at) nor .Quarantine; those
+# are only purged, see purge_maildir.
+PROCESSED_FOLDERS = (
+    '.Bad-Recipient',
+    '.Junk-Autoreply',
+    '.Junk-Deleted',
+)
+
+# Keep two weeks in the maildir, so the replay module (which reads the
+# maildir folders only) can still reclassify recent mail.
+ARCHIVE_AFTER_DAYS = 14
+
+
+def get_recipient(filename, parser, dispatcher):
+    "Returns the original recipient, if the handlers can tell"
+    with open(filename, 'rb') as fp:
+        stat = os.fstat(fp.fileno())
+        parsed = parser.parse(fp)
+    efile = mailproc.EmailFile(filename, stat, parsed)
+    try:
+        dispatcher.dispatch(efile)
+    except Exception:
+        pass  # we only want the recipient, if any
+    try:
+        return efile.get_original_recipient()
+    except AttributeError:
+        return ''
+
+
+def write_archive(archive_path, filenames, recipient_of):
+    """
+    Add filenames to archive_path (and its index) atomically. Files that
+    are already in the archive are not added again. Returns the filenames
+    that are now safe to remove.
+    """
+    index_path = archive_path[:-len('.tar.gz')] + '.idx'
+    index_lines = []
+    known = set()
+    if os.path.exists(index_path):
+        with open(index_path) as fp:
+            index_lines = fp.readlines()
+        known = set(line.split('\t', 1)[0] for line in index_lines)
+
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    tmp_path = archive_path + '.tmp'
+    with tarfile.open(tmp_path, 'w:gz') as tar:
+        if os.path.exists(archive_path):
+            with tarfile.open(archive_path, 'r:gz') as old_tar:
+                for member in old_tar:
+                    tar.addfile(member, old_tar.extractfile(member))
+
+        for filename in filenames:
+            basename = os.path.basename(filename)
+            if basename in known:
+                continue
+            stat = os.stat(filename)
+            tar.add(filename, arcname=basename, recursive=False)
+            index_lines.append('{}\t{}\t{}\t{}\n'.format(
+                basename, int(stat.st_mtime), stat.st_size,
+                recipient_of(filename)))
+            known.add(basename)
+
+    with open(index_path + '.tmp', 'w') as fp:
+        fp.writelines(index_lines)
+    os.rename(tmp_path, archive_path)
+    os.rename(index_path + '.tmp', index_path)
+    return filenames
+
+
+def archive_folder(maildir, folder, archive_dir, after_days, now=None):
+    """
+    Archive the mails in maildir/folder that are older than after_days
+    days, grouped by (UTC) day of their mtime.
+    """
+    now = now or datetime.utcnow()
+    cutoff = (now - timedelta(days=after_days)).date()
+    by_day = defaultdict(list)
+    for subdir in ('cur', 'new'):
+        path = os.path.join(maildir, folder, subdir)
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            if name.startswith('.'):
+                continue
+            filename = os.path.join(path, name)
+            day = datetime.utcfromtimestamp(os.stat(filename).st_mtime).date()
+            if day < cutoff:
+                by_day[day].append(filename)
+
+    parser = mailproc.MailParser()
+    dispatcher = mailproc.HandlerDispatcher()
+    for day, filenames in sorted(by_day.items()):
+        archive_path = os.path.join(
+            archive_dir, folder.lstrip('.'), day.strftime('%Y'),
+            day.strftime('%Y-%m-%d.tar.gz'))
+        done = write_archive(
+            archive_path, sorted(filenames),
+            (lambda fn: get_recipient(fn, parser, dispatcher)))
+        for filename in done:
+            os.unlink(filename)
+        log.info('Archived %d files to %s', len(done), archive_path)
+
+
+def purge(archive_dir, retention_days, now=None):
+    "Remove archives (and indexes) older than retention_days days"
+    now = now or datetime.utcnow()
+    cutoff = (now - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+    for dirpath, dirnames, filenames in os.walk(archive_dir, topdown=False):
+        for name in filenames:
+            if name.endswith(('.tar.gz', '.idx')) and name[0:10] < cutoff:
+                os.unlink(os.path.join(dirpath, name))
+                log.info('Purged %s', os.path.join(dirpath, name))
+        if dirpath != archive_dir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def purge_maildir(maildir, retention_days, now=None):
+    """
+    Remove mails older than retention_days days from anywhere in maildir,
+    e.g. the .Junk-Checkme and .Quarantine folders, which are not archived.
+    Also drops the older errors.jsonl records.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=retention_days)
+    cutoff_ts = (cutoff - datetime(1970, 1, 1)).total_seconds()
+    for dirpath, dirnames, filenames in os.walk(maildir):
+        if os.path.basename(dirpath) in ('cur', 'new'):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if (name[0:1].isdigit() and
+                        os.stat(filename).st_mtime < cutoff_ts):
+                    os.unlink(filename)
+                    log.info('Purged %s', filename)
+        elif 'errors.jsonl' in filenames:
+            purge_error_records(
+                os.path.join(dirpath, 'errors.jsonl'),
+                cutoff.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+
+def purge_error_records(errors_jsonl, cutoff):
+    with open(errors_jsonl) as fp:
+        lines = fp.readlines()
+    keep = [line for line in lines if json.loads(line)['time'] >= cutoff]
+    if len(keep) != len(lines):
+        with open(errors_jsonl + '.tmp', 'w') as fp:
+            fp.writelines(keep)
+        os.rename(errors_jsonl + '.tmp', errors_jsonl)
+
+
+def lookup(archive_dir, term):
+    """
+    Yields (archive_path, filename, recipient) for index entries where the
+    filename or recipient contains term (case insensitive).
+    """
+    term = term.lower()
+    for dirpath, dirnames, filenames in os.walk(archive_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if not name.endswith('.idx'):
+                continue
+            index_path = os.path.join(dirpath, name)
+            with open(index_path) as fp:
+                for line in fp:
+                    filename, mtime, size, recipient = (
+                        line.rstrip('\n').split('\t'))
+                    if term in filename.lower() or term in recipient.lower():
+                        yield (
+                            index_path[:-len('.idx')] + '.tar.gz',
+                            filename, recipient)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Archive processed bounces into compressed per-day archives, '
+        'purge expired archives, or look up mails in them.'))
+    parser.add_argument('-v', '--verbose', action='store_true', help=(
+        'Verbose mode.'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sub = subparsers.add_parser('archive', help=(
+        'Move processed mails from the maildir into the archives.'))
+    sub.add_argument('maildir', help=(
+        'Maildir root, holding the .Bad-Recipient etc. folders.'))
+    sub.add_argument('archive_dir')
+    sub.add_argument(
+        '--after-days', type=int, default=ARCHIVE_AFTER_DAYS, help=(
+            'Only archive mails older than this many days (default: '
+            '{}).'.format(ARCHIVE_AFTER_DAYS)))
+
+    sub = subparsers.add_parser('purge', help=(
+        'Remove archives older than the retention period.'))
+    sub.add_argument('archive_dir')
+    sub.add_argument('--days', type=int, default=180, help=(
+        'Retention in days (default: 180).'))
+    sub.add_argument('--maildir', help=(
+        'Also remove mails older than the retention period from this '
+        'maildir, e.g. from the folders that are not archived '
+        '(.Junk-Checkme, .Quarantine).'))
+
+    sub = subparsers.add_parser('lookup', help=(
+        'Find archived mails by (partial) filename or recipient.'))
+    sub.add_argument('archive_dir')
+    sub.add_argument('term')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)-15s: %(levelname)s: %(message)s',
+        level=('DEBUG' if args.verbose else 'WARNING'))
+
+    if args.command == 'archive':
+        for folder in PROCESSED_FOLDERS:
+            archive_folder(
+                args.maildir, folder, args.archive_dir, args.after_days)
+    elif args.command == 'purge':
+        purge(args.archive_dir, args.days)
+        if args.maildir:
+            purge_maildir(args.maildir, args.days)
+    elif args.command == 'lookup':
+        for archive_path, filename, recipient in lookup(
+                args.archive_dir, args.term):
+            print('{}\t{}\t{}'.format(archive_path, filename, recipient))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception:
+        traceback.print_exc()
+        sys.exit(255)
@@ -0,0 +1,108 @@
+import json
+import os
+import tarfile
+
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from . import archive
+
+
+def write_mail(path, name, body):
+    os.makedirs(path, exist_ok=True)
+    filename = os.path.join(path, name)
+    with open(filename, 'w') as fp:
+        fp.write(body)
+    return filename
+
+
+class TestWriteArchive(TestCase):
+    def test_append_without_duplicates(self):
+        with TemporaryDirectory() as tmpdir:
+            new = os.path.join(tmpdir, 'maildir', 'new')
+            archive_path = os.path.join(
+                tmpdir, 'archive', '2020', '2020-01-02.tar.gz')
+            recipients = {'1.eml': 'a@example.nl', '2.eml': 'b@example.nl'}
+            recipient_of = (lambda fn: recipients[os.path.basename(fn)])
+
+            first = [write_mail(new, '1.eml', 'one')]
+            self.assertEqual(
+                archive.write_archive(archive_path, first, recipient_of),
+                first)
+
+            # A second run adds the new file and skips the known one.
+            second = [
+                write_mail(new, '1.eml', 'one again'),
+                write_mail(new, '2.eml', 'two')]
+            self.assertEqual(
+                archive.write_archive(archive_path, second, recipient_of),
+                second)
+
+            with tarfile.open(archive_path, 'r:gz') as tar:
+                self.assertEqual(tar.getnames(), ['1.eml', '2.eml'])
+                self.assertEqual(
+                    tar.extractfile('1.eml').read(), b'one')
+            with open(archive_path[:-len('.tar.gz')] + '.idx') as fp:
+                index = [line.rstrip('\n').split('\t') for line in fp]
+            self.assertEqual(
+                [(i[0], i[3]) for i in index],
+                [('1.eml', 'a@example.nl'), ('2.eml', 'b@example.nl')])
+            self.assertFalse(os.path.exists(archive_path + '.tmp'))
+
+
+class TestPurge(TestCase):
+    def test_cutoff(self):
+        with TemporaryDirectory() as tmpdir:
+            year = os.path.join(tmpdir, 'Bad-Recipient', '2020')
+            for day in ('2020-01-01', '2020-01-02', '2020-01-03'):
+                write_mail(year, day + '.tar.gz', '')
+                write_mail(year, day + '.idx', '')
+            old_year = os.path.join(tmpdir, 'Bad-Recipient', '2019')
+            write_mail(old_year, '2019-12-31.tar.gz', '')
+
+            archive.purge(tmpdir, 10, now=datetime(2020, 1, 12, 12, 0))
+            self.assertEqual(sorted(os.listdir(year)), [
+                '2020-01-02.idx', '2020-01-02.tar.gz',
+                '2020-01-03.idx', '2020-01-03.tar.gz'])
+            self.assertFalse(os.path.exists(old_year))
+
+    def test_maildir(self):
+        now = datetime(2020, 7, 1)
+        old = (datetime(2020, 1, 1) - datetime(1970, 1, 1)).total_seconds()
+        with TemporaryDirectory() as tmpdir:
+            names = []
+            for folder in ('.Quarantine/new', '.Junk-Checkme/cur', 'new'):
+                path = os.path.join(tmpdir, folder)
+                names.append(write_mail(path, '1577836800.M1.mx', 'old'))
+                os.utime(names[-1], (old, old))
+                names.append(write_mail(path, '1593561600.M2.mx', 'new'))
+            errors_jsonl = write_mail(
+                os.path.join(tmpdir, '.Quarantine'), 'errors.jsonl', (
+                    '{"time": "2020-01-01T00:00:00Z", "filename": "a"}\n'
+                    '{"time": "2020-06-30T00:00:00Z", "filename": "b"}\n'))
+
+            archive.purge_maildir(tmpdir, 180, now=now)
+            self.assertEqual(
+                [os.path.exists(name) for name in names],
+                [False, True] * 3)
+            with open(errors_jsonl) as fp:
+                self.assertEqual(
+                    [json.loads(line)['filename'] for line in fp], ['b'])
+
+
+class TestLookup(TestCase):
+    def test_lookup(self):
+        with TemporaryDirectory() as tmpdir:
+            year = os.path.join(tmpdir, 'Bad-Recipient', '2020')
+            write_mail(year, '2020-01-02.idx', (
+                '1577966400.M1P2.mx\t1577966400\t100\tA@example.nl\n'
+                '1577966401.M3P4.mx\t1577966401\t100\tb@example.nl\n'
+                '1577966402.M5P6.mx\t1577966402\t100\t\n'))
+            archive_path = os.path.join(year, '2020-01-02.tar.gz')
+
+            self.assertEqual(list(archive.lookup(tmpdir, 'a@EXAMPLE')), [
+                (archive_path, '1577966400.M1P2.mx', 'A@example.nl')])
+            self.assertEqual(list(archive.lookup(tmpdir, 'M5P6')), [
+                (archive_path, '1577966402.M5P6.mx', '')])
+            self.assertEqual(list(archive.lookup(tmpdir, 'nobody@')), [])
@@ -0,0 +1,144 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Persistent index of delayed (Email4xx) recipients.
+
+A delay is recorded once per mail. It is resolved when an Email5xx for the
+same (from, to) arrives, or when no further delay arrives for expire_days
+days (the mail got delivered after all). Recipients that keep delaying for
+escalate_days days are escalated: treated as invalid recipients, and
+resolved once that is published.
+
+The pipe mode updates the index per mail, under the lock (see locked()). A
+batch run cannot hold the lock that long: it works on a copy (see
+loaded()), and its changes are applied to the then current index at the
+end.
+"""
+import json
+import os
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from .locking import locked
+from .mailproc import BounceRecord
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+SEEN_DAYS = 30  # remember processed filenames this long
+
+
+def maildir_basename(filename):
+    "Returns the unique part of a maildir filename (without the :2,flags)"
+    return os.path.basename(filename).split(':', 1)[0]
+
+
+class DelayedIndex:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # "from to" => dict
+        self.seen = {}  # maildir basename => date processed
+        self.changes = []  # (method name, args), see apply()
+        if os.path.exists(path):
+            with open(path) as fp:
+                data = json.load(fp)
+            self.entries = data['entries']
+            self.seen = data['seen']
+
+    @classmethod
+    @contextmanager
+    def locked(cls, path):
+        "Yields the loaded index and saves it if the with-block completes"
+        with locked(path):
+            index = cls(path)
+            yield index
+            index.save()
+
+    @classmethod
+    @contextmanager
+    def loaded(cls, path):
+        """
+        Yields the loaded index, holding the lock only while loading. If
+        the with-block completes, its changes are applied to the current
+        index (which may have been updated meanwhile) under the lock.
+        """
+        with locked(path):
+            index = cls(path)
+        yield index
+        with cls.locked(path) as current:
+            current.apply(index.changes)
+
+    def apply(self, changes):
+        for method, args in changes:
+            getattr(self, method)(*args)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump({'entries': self.entries, 'seen': self.seen}, fp)
+        os.rename(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_seen(self, filename):
+        return maildir_basename(filename) in self.seen
+
+    def add(self, efile, rcpt):
+        self._add(
+            efile.get_original_envelope_from().lower(), rcpt.lower(),
+            efile.get_date().strftime(DATE_FORMAT))
+        # Only files that stay in place can be seen again; not the pipe
+        # mode <stdin>, nor archive members.
+        if efile.movable:
+            self._seen(
+                maildir_basename(efile.filename),
+                datetime.utcnow().strftime(DATE_FORMAT))
+
+    def _add(self, envelope_from, rcpt, date):
+        key = '{} {}'.format(envelope_from, rcpt)
+        entry = self.entries.setdefault(key, {
+            'from': envelope_from, 'to': rcpt,
+            'first_seen': date, 'last_seen': date, 'count': 0})
+        entry['first_seen'] = min(entry['first_seen'], date)
+        entry['last_seen'] = max(entry['last_seen'], date)
+        entry['count'] += 1
+        self.changes.append(('_add', (envelope_from, rcpt, date)))
+
+    def _seen(self, basename, date):
+        self.seen[basename] = date
+        self.changes.append(('_seen', (basename, date)))
+
+    def _drop(self, key):
+        self.changes.append(('_drop', (key,)))
+        return self.entries.pop(key, None) is not None
+
+    def resolve(self, envelope_from, rcpt):
+        "Drop the delay, because a final response arrived"
+        return self._drop('{} {}'.format(envelope_from, rcpt).lower())
+
+    def expire(self, escalate_days, expire_days, now=None):
+        """
+        Drop delays that stopped, and return BounceRecords for the ongoing
+        delays that lasted escalate_days or more. Those are kept until they
+        are resolve()d, so a failed publish is escalated again next time.
+        """
+        now = now or datetime.utcnow()
+        escalated = []
+        for key, entry in list(self.entries.items()):
+            first_seen = datetime.strptime(entry['first_seen'], DATE_FORMAT)
+            last_seen = datetime.strptime(entry['last_seen'], DATE_FORMAT)
+            if now - last_seen >= timedelta(days=expire_days):
+                self._drop(key)
+            elif last_seen - first_seen >= timedelta(days=escalate_days):
+                escalated.append(BounceRecord(
+                    '<delayed-index>', last_seen, entry['from'],
+                    entry['to']))
+
+        self._prune_seen(
+            (now - timedelta(days=SEEN_DAYS)).strftime(DATE_FORMAT))
+        return escalated
+
+    def _prune_seen(self, seen_expire):
+        self.seen = dict(
+            (filename, date) for filename, date in self.seen.items()
+            if date >= seen_expire)
+        self.changes.append(('_prune_seen', (seen_expire,)))
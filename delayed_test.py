@@ -0,0 +1,100 @@
+import os
+
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from .delayed import DelayedIndex
+from .mailproc import BounceRecord
+
+
+class FakeEmailFile(BounceRecord):
+    movable = True
+
+
+def make_efile(date, rcpt='a@example.nl', movable=True,
+               filename='/maildir/new/1577966400.M1P2.mx:2,S'):
+    cls = FakeEmailFile if movable else BounceRecord
+    return cls(filename, date, 'NoReply@example.com', rcpt)
+
+
+class TestDelayedIndex(TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'delayed.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_add(self):
+        index = DelayedIndex(self.path)
+        index.add(make_efile(datetime(2020, 1, 3)), 'A@example.nl')
+        index.add(make_efile(datetime(2020, 1, 2)), 'a@example.nl')
+        self.assertEqual(index.entries, {
+            'noreply@example.com a@example.nl': {
+                'from': 'noreply@example.com', 'to': 'a@example.nl',
+                'first_seen': '2020-01-02T00:00:00',
+                'last_seen': '2020-01-03T00:00:00', 'count': 2}})
+        self.assertTrue(index.is_seen('/maildir/cur/1577966400.M1P2.mx:2,'))
+
+    def test_add_not_movable(self):
+        index = DelayedIndex(self.path)
+        index.add(make_efile(
+            datetime(2020, 1, 2), movable=False, filename='<stdin>'),
+            'a@example.nl')
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.seen, {})
+
+    def test_resolve(self):
+        index = DelayedIndex(self.path)
+        index.add(make_efile(datetime(2020, 1, 2)), 'a@example.nl')
+        self.assertFalse(index.resolve('noreply@example.com', 'b@example.nl'))
+        self.assertTrue(index.resolve('NoReply@example.com', 'A@example.nl'))
+        self.assertEqual(len(index), 0)
+
+    def test_expire_and_escalate(self):
+        index = DelayedIndex(self.path)
+        # Stopped delaying: expired.
+        index.add(make_efile(datetime(2020, 1, 1)), 'stopped@example.nl')
+        # Delaying for 4 days: escalated.
+        index.add(make_efile(datetime(2020, 1, 6)), 'long@example.nl')
+        index.add(make_efile(datetime(2020, 1, 10)), 'long@example.nl')
+        # Delaying for a day: kept.
+        index.add(make_efile(datetime(2020, 1, 9)), 'short@example.nl')
+        index.add(make_efile(datetime(2020, 1, 10)), 'short@example.nl')
+
+        escalated = index.expire(4, 2, now=datetime(2020, 1, 10, 12, 0))
+        self.assertEqual(
+            [(i.get_original_envelope_from(), i.get_original_recipient(),
+              i.get_date()) for i in escalated],
+            [('noreply@example.com', 'long@example.nl',
+              datetime(2020, 1, 10))])
+        self.assertEqual(list(index.entries), [
+            'noreply@example.com long@example.nl',
+            'noreply@example.com short@example.nl'])
+        # Once published, the escalated delay is resolved.
+        self.assertTrue(
+            index.resolve('noreply@example.com', 'long@example.nl'))
+
+    def test_prune_seen(self):
+        index = DelayedIndex(self.path)
+        index.seen = {
+            'old': '2019-12-01T00:00:00', 'recent': '2020-01-09T00:00:00'}
+        index.expire(4, 2, now=datetime(2020, 1, 10))
+        self.assertEqual(list(index.seen), ['recent'])
+
+    def test_loaded_merges_concurrent_changes(self):
+        with DelayedIndex.locked(self.path) as index:
+            index.add(make_efile(datetime(2020, 1, 2)), 'a@example.nl')
+            index.add(make_efile(datetime(2020, 1, 2)), 'b@example.nl')
+
+        with DelayedIndex.loaded(self.path) as batch:
+            batch.resolve('noreply@example.com', 'a@example.nl')
+            # Meanwhile, the pipe mode adds a delay.
+            with DelayedIndex.locked(self.path) as pipe:
+                pipe.add(make_efile(
+                    datetime(2020, 1, 3), movable=False), 'c@example.nl')
+
+        self.assertEqual(sorted(DelayedIndex(self.path).entries), [
+            'noreply@example.com b@example.nl',
+            'noreply@example.com c@example.nl'])
@@ -0,0 +1,22 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Exclusive locks around read-modify-write of the shared state files (the
+spool, the delayed index and the suppression table).
+"""
+import fcntl
+
+from contextlib import contextmanager
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive flock for path, on path.lock. A separate lock file is
+    used, so path itself can be renamed or replaced while locked.
+    """
+    with open(path + '.lock', 'a') as lockfp:
+        fcntl.flock(lockfp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfp.fileno(), fcntl.LOCK_UN)
@@ -1,12 +1,17 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
+import hashlib
+import json
+import mailbox
 import os
+import re
 import warnings
 
 from collections import defaultdict
 from datetime import datetime
+from traceback import format_exception
 
 from email.header import decode_header, make_header
-from email.parser import BytesParser
+from email.parser import BytesParser, HeaderParser
 
 
 MailParser = BytesParser  # export
@@ -59,11 +64,16 @@ class HopCountExceeded(Email4xx):
     pass
 
 
+class DuplicateEmail(EmailResponse):
+    pass
+
+
 class EmailFile:
-    def __init__(self, filename, stat, email):
+    def __init__(self, filename, stat, email, movable=True):
         self.filename = filename
         self.stat = stat
         self.email = email
+        self.movable = movable  # False for mbox/archive members
 
     def is_from_mailer_daemon(self):
         if not hasattr(self, '_is_from_mailer_daemon'):
@@ -95,6 +105,75 @@ class EmailFile:
                 make_header(decode_header(self.email.get('Subject'))))
         return self._get_subject
 
+    def get_message_id(self):
+        if not hasattr(self, '_get_message_id'):
+            message_id = self.email.get('Message-ID')
+            self._get_message_id = (
+                message_id.strip() if message_id else None)
+        return self._get_message_id
+
+    def get_shallow_parts(self):
+        "Returns the MIME parts of the top two levels, without a full walk"
+        if not hasattr(self, '_get_shallow_parts'):
+            parts = []
+            if self.email.is_multipart():
+                for part in self.email.get_payload():
+                    parts.append(part)
+                    if part.get_content_maintype() == 'multipart':
+                        parts.extend(part.get_payload())
+            self._get_shallow_parts = parts
+        return self._get_shallow_parts
+
+    def get_original_fingerprint(self):
+        "Returns the Message-ID (or a header hash) of the bounced original"
+        if not hasattr(self, '_get_original_fingerprint'):
+            self._get_original_fingerprint = None
+            for part in self.get_shallow_parts():
+                if part.get_content_type() == 'message/rfc822':
+                    original = part.get_payload(0)
+                elif part.get_content_type() == 'text/rfc822-headers':
+                    original = HeaderParser().parsestr(
+                        part.get_payload(decode=True).decode(
+                            'ascii', 'replace'))
+                else:
+                    continue
+
+                message_id = original.get('Message-ID')
+                if message_id:
+                    self._get_original_fingerprint = message_id.strip()
+                else:
+                    headers = [
+                        str(original.get(i, ''))
+                        for i in ('From', 'To', 'Date', 'Subject')]
+                    if any(headers):
+                        self._get_original_fingerprint = hashlib.sha1(
+                            '\n'.join(headers).encode('utf-8', 'replace')
+                        ).hexdigest()
+                break
+        return self._get_original_fingerprint
+
+    def get_signature(self):
+        "Returns a structural signature of the (bounce) mail layout"
+        if not hasattr(self, '_get_signature'):
+            from_ = self.email.get('From') or ''
+            sender_domain = from_.rsplit('@', 1)[-1].strip(' >').lower()
+            skeleton = tuple(
+                i.get_content_type() for i in self.email.walk())
+            boundary = self.email.get_boundary() or ''
+            boundary = re.sub(r'[0-9A-Fa-f]{8,}', 'X', boundary)
+            boundary = re.sub(r'[0-9]+', '9', boundary)
+            key_headers = tuple(
+                (header, self.email.get(header))
+                for header in SIGNATURE_HEADERS if header in self.email) + \
+                tuple(
+                    header for header in SIGNATURE_PRESENCE_HEADERS
+                    if header in self.email)
+            self._get_signature = (
+                self.is_from_mailer_daemon(), sender_domain,
+                self.email.get_content_type(), skeleton, boundary,
+                key_headers)
+        return self._get_signature
+
     def get_calendar_reply_body(self):
         calendar = [
             i for i in self.email.walk()
@@ -164,6 +243,79 @@ class EmailFile:
         self._manual_original_recipient = original_recipient
 
 
+# Headers that the handlers look at. Their values (or only their presence)
+# are part of the signature, to group the unknown formats by.
+SIGNATURE_HEADERS = (
+    'Auto-Submitted',
+    'Precedence',
+    'X-Zarafa-Vacation',
+)
+SIGNATURE_PRESENCE_HEADERS = (
+    'X-Failed-Recipients',
+)
+
+# Subjects of auto-replies, see valid_user_autoreply.
+AUTOREPLY_SUBJECTS = (
+    'Automatisch antwoord: ',
+    # "Automatisch antwooord:"
+    '=?utf-8?B?QXV0b21hdGlzY2ggYW50d29vcmQ6',
+    'Automatic reply: ',
+    'Niet aanwezig: ',
+    # "Niet aanwezig: "
+    '=?utf-8?B?TmlldCBhYW53ZXppZzog',
+    'Out of Office: ',
+    '*SPAM*  Automatisch antwoord: ',
+)
+
+
+class BounceRecord:
+    """
+    Stand-in for an EmailFile that was classified as Email5xx earlier, e.g.
+    one read back from the spool. Usable in the InvalidAddressCollector.
+    """
+    movable = False
+
+    def __init__(self, filename, date, envelope_from, recipient):
+        self.filename = filename
+        self.date = date
+        self.envelope_from = envelope_from
+        self.recipient = recipient
+
+    @classmethod
+    def from_efile(cls, efile):
+        return cls(
+            efile.filename, efile.get_date(),
+            efile.get_original_envelope_from(),
+            efile.get_original_recipient())
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(
+            record['filename'],
+            datetime.strptime(record['date'], '%Y-%m-%dT%H:%M:%S'),
+            record['from'], record['to'])
+
+    def as_dict(self):
+        return {
+            'filename': self.filename,
+            'date': self.date.strftime('%Y-%m-%dT%H:%M:%S'),
+            'from': self.envelope_from,
+            'to': self.recipient,
+        }
+
+    def get_date(self):
+        return self.date
+
+    def get_original_envelope_from(self):
+        return self.envelope_from
+
+    def get_original_recipient(self):
+        return self.recipient
+
+    def __repr__(self):
+        return '<filename={!r}>'.format(self.filename)
+
+
 def valid_user_reply(efile):
     if not efile.is_from_mailer_daemon():
         # Manually check these? Add them?
@@ -202,17 +354,8 @@ def valid_daemon_autoreply(efile):
 
 
 def valid_user_autoreply(efile):
-    if efile.is_from_mailer_daemon() and efile.get_subject().startswith((
-            'Automatisch antwoord: ',
-            # "Automatisch antwooord:"
-            '=?utf-8?B?QXV0b21hdGlzY2ggYW50d29vcmQ6',
-            'Automatic reply: ',
-            'Niet aanwezig: ',
-            # "Niet aanwezig: "
-            '=?utf-8?B?TmlldCBhYW53ZXppZzog',
-            'Out of Office: ',
-            '*SPAM*  Automatisch antwoord: ',
-            )):
+    if (efile.is_from_mailer_daemon() and
+            efile.get_subject().startswith(AUTOREPLY_SUBJECTS)):
         raise efile.ignore_and_drop_exception()
 
 
@@ -371,6 +514,123 @@ handlers = (
 )
 
 
+class HandlerDispatcher:
+    """
+    Run the handlers over an EmailFile, counting which handler resolved how
+    many mails. The name of the resolving handler is set on the raised
+    exception as handler. Mails that no handler resolves are collected in
+    the unknown dict by signature (see EmailFile.get_signature), instead of
+    silently disappearing in the EmailNotParsed traceback.
+    """
+    def __init__(self, handlers=handlers):
+        self.handlers = handlers
+        self.unknown = defaultdict(list)  # signature => filenames
+        self.handlers_count = defaultdict(int)
+
+    def dispatch(self, efile):
+        for handler in self.handlers:
+            try:
+                handler(efile)
+            except EmailResponse as e:
+                e.handler = handler.__name__
+                self.handlers_count[handler.__name__] += 1
+                raise
+            except EmailNotParsed as e:
+                e.handler = handler.__name__
+                self.unknown[efile.get_signature()].append(efile.filename)
+                self.handlers_count[handler.__name__] += 1
+                raise
+
+        raise NotImplementedError(
+            'programming error on: {fn}'.format(fn=efile.filename))
+
+
+# Scans of the raw bytes, to recognise the original of a DSN bounce
+# without the full MIME parse.
+RAW_ORIGINAL_PART_RE = re.compile(
+    rb'^Content-Type:[ \t]*(?:message/rfc822|text/rfc822-headers)',
+    re.I | re.M)
+RAW_HEADERS_END_RE = re.compile(rb'\n\r?\n')
+RAW_MESSAGE_ID_RE = re.compile(rb'^Message-ID:\s*(\S+)', re.I | re.M)
+RAW_FINAL_RCPT_RE = re.compile(
+    rb'^Final-Recipient:[ \t]*rfc822;[ \t]*(\S+)', re.I | re.M)
+RAW_STATUS_RE = re.compile(rb'^Status:[ \t]*([245])\.', re.I | re.M)
+
+
+def get_raw_fingerprints(data):
+    """
+    Returns the Message-ID of the mail and the (original Message-ID,
+    recipient) of a 5xx DSN, from a scan of the raw bytes only. Either may
+    be None if it cannot be found cheaply.
+    """
+    headers_end = RAW_HEADERS_END_RE.search(data)
+    message_id = RAW_MESSAGE_ID_RE.search(
+        data, 0, headers_end.start() if headers_end else len(data))
+    message_id = (
+        message_id.group(1).decode('ascii', 'replace')
+        if message_id else None)
+
+    original = None
+    status = RAW_STATUS_RE.search(data)
+    if status and status.group(1) == b'5':
+        rcpt = RAW_FINAL_RCPT_RE.search(data)
+        part = RAW_ORIGINAL_PART_RE.search(data)
+        original_id = part and RAW_MESSAGE_ID_RE.search(data, part.end())
+        if rcpt and original_id:
+            original = (
+                original_id.group(1).decode('ascii', 'replace'),
+                rcpt.group(1).decode('ascii', 'replace').lower())
+    return message_id, original
+
+
+class DuplicateIndex:
+    """
+    Recognise bounces we have seen before in this run.
+
+    Relays retry, and bounces get delivered twice. Exact copies (same
+    Message-ID) and 5xx DSNs for the same original and recipient are
+    recognised from the headers and raw bytes, before the full parse. For
+    bounces in other layouts, is_duplicate_recipient() is checked after the
+    handlers, using the fingerprint of the embedded original, so they're
+    counted only once.
+
+    The index lives in memory, for one run only. Duplicates spread over
+    several runs (or pipe deliveries) are not recognised.
+    """
+    def __init__(self):
+        self.message_ids = set()
+        self.raw_originals = set()
+        self.originals = set()
+        self.duplicates = 0
+
+    def skip_duplicate(self, filename, data):
+        "Raises DuplicateEmail if the raw mail data was seen before"
+        self.skip_fingerprints(filename, *get_raw_fingerprints(data))
+
+    def skip_fingerprints(self, filename, message_id, original):
+        "Like skip_duplicate(), for get_raw_fingerprints() done elsewhere"
+        if message_id and message_id in self.message_ids:
+            self.duplicates += 1
+            raise DuplicateEmail(filename)
+        if original and original in self.raw_originals:
+            self.duplicates += 1
+            raise DuplicateEmail(filename)
+        if message_id:
+            self.message_ids.add(message_id)
+        if original:
+            self.raw_originals.add(original)
+
+    def is_duplicate_recipient(self, efile, rcpt):
+        fingerprint = efile.get_original_fingerprint()
+        if fingerprint:
+            key = (fingerprint, rcpt.lower())
+            if key in self.originals:
+                self.duplicates += 1
+                return True
+            self.originals.add(key)
+        return False
+
+
 class InvalidAddressList(list):
     def as_dict(self):
         # Previously, we assumed we were sorted. We may not be.
@@ -387,12 +647,42 @@ class InvalidAddressList(list):
             'to': any_.get_original_recipient(),
         }
 
+    def efiles(self):
+        return list(self)
+
     def __str__(self):
         return (
             '{first_seen}..{last_seen} {count:5d}x [from={from}] {to}'.format(
                 **self.as_dict()))
 
 
+class InvalidDomainList(list):
+    """
+    List of InvalidAddressLists for the same sender and recipient domain.
+    """
+    def as_dict(self):
+        docs = [i.as_dict() for i in self]
+        recipients = sorted(doc['to'] for doc in docs)
+        return {
+            'first_seen': min(doc['first_seen'] for doc in docs),
+            'last_seen': max(doc['last_seen'] for doc in docs),
+            'count': sum(doc['count'] for doc in docs),
+            'from': docs[0]['from'],
+            'domain': recipients[0].rsplit('@', 1)[-1].lower(),
+            'recipient_count': len(recipients),
+            'recipients': recipients,
+        }
+
+    def efiles(self):
+        return [efile for addrlist in self for efile in addrlist]
+
+    def __str__(self):
+        return (
+            '{first_seen}..{last_seen} {count:5d}x [from={from}] '
+            '@{domain} ({recipient_count} recipients)'.format(
+                **self.as_dict()))
+
+
 class InvalidAddressCollector:
     def __init__(self):
         self.by_from_to = defaultdict(InvalidAddressList)
@@ -404,18 +694,69 @@ class InvalidAddressCollector:
     def __bool__(self):
         return bool(self.by_from_to)
 
-    def add(self, efile):
+    def _key(self, efile):
         lower_from = efile.get_original_envelope_from().lower()
         lower_to = efile.get_original_recipient().lower()
         to_user, to_domain = lower_to.split('@', 1)
-        key = (lower_from, to_domain, to_user)  # sort-order (domain first)
-        self.by_from_to[key].append(efile)
+        return (lower_from, to_domain, to_user)  # sort-order (domain first)
+
+    def add(self, efile):
+        self.by_from_to[self._key(efile)].append(efile)
+
+    def remove(self, efile):
+        key = self._key(efile)
+        self.by_from_to[key].remove(efile)
+        if not self.by_from_to[key]:
+            del self.by_from_to[key]
+
+    def rollup_domains(self, min_recipients):
+        """
+        Like iter(), but yields a single InvalidDomainList instead of the
+        InvalidAddressLists when a sender saw min_recipients or more
+        failing recipients on the same domain.
+        """
+        by_domain = defaultdict(InvalidDomainList)
+        for key in sorted(self.by_from_to.keys()):
+            by_domain[key[0:2]].append(self.by_from_to[key])
+
+        for key in sorted(by_domain.keys()):
+            addrlists = by_domain[key]
+            if min_recipients and len(addrlists) >= min_recipients:
+                yield addrlists
+            else:
+                yield from addrlists
 
     def move_all_to(self, new_folder):
-        # Move to <new_directory>/
+        """
+        Move the movable emails to new_folder/. One failing move does not
+        stop the others; returns (efile, exception) for the failures.
+        """
+        failed = []
         for addrlist in self.by_from_to.values():
             for efile in addrlist:
-                move_email(efile.filename, new_folder)
+                if efile.movable:
+                    try:
+                        move_email(efile.filename, new_folder)
+                    except Exception as e:
+                        failed.append((efile, e))
+        return failed
+
+
+# Where classified emails end up. Subclasses before their parents.
+RESPONSE_FOLDERS = (
+    (DuplicateEmail, '.Junk-Deleted'),
+    (Email2xx, '.Junk-Autoreply'),
+    (Email299, '.Junk-Checkme'),
+    (Email4xx, '.Junk-Deleted'),
+    (Email5xx, '.Bad-Recipient'),
+)
+
+
+def response_folder(response):
+    for response_class, folder in RESPONSE_FOLDERS:
+        if isinstance(response, response_class):
+            return folder
+    return '.Quarantine'
 
 
 def move_email(filename, new_folder='.Junk'):
@@ -427,3 +768,65 @@ def move_email(filename, new_folder='.Junk'):
         filename.rsplit('/', 2)[0], new_folder, 'new',
         os.path.basename(filename))
     os.rename(filename, new_name)
+    return new_name
+
+
+def refile_email(filename, new_folder):
+    """
+    Like move_email(), but for a filename that was moved to a folder
+    already: MAILDIR/.Folder/{cur,new}/FILE. Keeps the cur/new subdir.
+    """
+    assert new_folder.startswith('.') and '/' not in new_folder
+    maildir, old_folder, subdir, basename = filename.rsplit('/', 3)
+    assert (
+        old_folder.startswith('.') and subdir in ('cur', 'new') and
+        old_folder != new_folder), filename
+    new_name = os.path.join(maildir, new_folder, subdir, basename)
+    os.rename(filename, new_name)
+    return new_name
+
+
+def deliver_email(maildir, new_folder, data):
+    """
+    Write data as a new mail into maildir/new_folder, creating the folder
+    if needed. Returns the filename.
+    """
+    assert new_folder.startswith('.') and '/' not in new_folder
+    folder = mailbox.Maildir(
+        os.path.join(maildir, new_folder), factory=None, create=True)
+    key = folder.add(data)
+    return os.path.join(maildir, new_folder, 'new', key)
+
+
+def quarantine_email(filename, error, new_folder='.Quarantine'):
+    """
+    Move the email that caused error to new_folder, and append an error
+    record to new_folder/errors.jsonl.
+    """
+    new_name = move_email(filename, new_folder)
+    write_error_record(
+        filename.rsplit('/', 2)[0], new_folder, filename, new_name,
+        error_details(error))
+    return new_name
+
+
+def error_details(error):
+    "The error, message and traceback of an exception, for the error record"
+    return {
+        'error': error.__class__.__name__,
+        'message': str(error),
+        'traceback': ''.join(format_exception(
+            type(error), error, error.__traceback__)),
+    }
+
+
+def write_error_record(maildir, new_folder, filename, new_name, details):
+    record = {
+        'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'filename': filename,
+        'new_filename': new_name,
+    }
+    record.update(details)
+    errors_jsonl = os.path.join(maildir, new_folder, 'errors.jsonl')
+    with open(errors_jsonl, 'a') as fp:
+        fp.write(json.dumps(record) + '\n')
@@ -1,5 +1,7 @@
+import json
 import os
 
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
 from . import mailproc
@@ -49,4 +51,218 @@ class TestMailInTestdata(TestCase):
                                 expected_etype, filename))
 
 
+BOUNCE_TEMPLATE = b'''\
+Return-Path: <MAILER-DAEMON>
+Delivered-To: noreply@example.com
+Message-ID: <%(msgid)s>
+Subject: Undelivered Mail Returned to Sender
+Content-Type: multipart/report; report-type=delivery-status;
+ boundary="BOUNDARY"
+MIME-Version: 1.0
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mx.example.com
+
+Final-Recipient: rfc822; %(rcpt)s
+Action: failed
+Status: 5.1.1
+
+--BOUNDARY
+Content-Type: text/rfc822-headers
+
+From: noreply@example.com
+To: %(rcpt)s
+Message-ID: <%(original)s>
+Subject: Hello
+
+--BOUNDARY--
+'''
+
+
+def make_data(msgid='bounce-1', rcpt='a@example.nl', original='original-1'):
+    return BOUNCE_TEMPLATE % {
+        b'msgid': msgid.encode(), b'rcpt': rcpt.encode(),
+        b'original': original.encode()}
+
+
+def make_efile(filename='1.eml', msgid='bounce-1', rcpt='a@example.nl',
+               original='original-1'):
+    data = make_data(msgid, rcpt, original)
+    stat = os.stat(__file__)
+    return mailproc.EmailFile(
+        filename, stat, mailproc.MailParser().parsebytes(data))
+
+
+class TestDuplicateIndex(TestCase):
+    def test_raw_fingerprints(self):
+        self.assertEqual(
+            mailproc.get_raw_fingerprints(make_data(rcpt='A@example.nl')),
+            ('<bounce-1>', ('<original-1>', 'a@example.nl')))
+        delayed = make_data().replace(b'Status: 5.1.1', b'Status: 4.4.1')
+        self.assertEqual(
+            mailproc.get_raw_fingerprints(delayed), ('<bounce-1>', None))
+        # Only the header block counts for the Message-ID of the mail; a
+        # folded header is fine.
+        no_id = make_data().replace(b'Message-ID: <bounce-1>\n', b'')
+        self.assertEqual(
+            mailproc.get_raw_fingerprints(no_id)[0], None)
+        folded = make_data().replace(
+            b'Message-ID: <bounce-1>', b'Message-ID:\r\n <bounce-1>')
+        self.assertEqual(
+            mailproc.get_raw_fingerprints(folded)[0], '<bounce-1>')
+
+    def test_same_message_id(self):
+        dedup = mailproc.DuplicateIndex()
+        dedup.skip_duplicate('1.eml', make_data(rcpt='a@example.nl'))
+        with self.assertRaises(mailproc.DuplicateEmail):
+            dedup.skip_duplicate('2.eml', make_data(rcpt='b@example.nl'))
+        self.assertEqual(dedup.duplicates, 1)
+
+    def test_same_raw_original(self):
+        dedup = mailproc.DuplicateIndex()
+        dedup.skip_duplicate('1.eml', make_data(msgid='bounce-1'))
+        dedup.skip_duplicate('2.eml', make_data(
+            msgid='bounce-2', rcpt='b@example.nl'))
+        with self.assertRaises(mailproc.DuplicateEmail):
+            dedup.skip_duplicate('3.eml', make_data(
+                msgid='bounce-3', rcpt='A@example.nl'))
+        self.assertEqual(dedup.duplicates, 1)
+
+    def test_same_original(self):
+        dedup = mailproc.DuplicateIndex()
+        efile = make_efile(msgid='bounce-1')
+        self.assertEqual(efile.get_original_fingerprint(), '<original-1>')
+        self.assertFalse(dedup.is_duplicate_recipient(efile, 'a@example.nl'))
+        self.assertFalse(dedup.is_duplicate_recipient(
+            make_efile(msgid='bounce-2'), 'b@example.nl'))
+        self.assertTrue(dedup.is_duplicate_recipient(
+            make_efile(msgid='bounce-3'), 'A@example.nl'))
+
+
+class TestHandlerDispatcher(TestCase):
+    def test_handler(self):
+        dispatcher = mailproc.HandlerDispatcher()
+        for msgid in ('bounce-1', 'bounce-2'):
+            with self.assertRaises(mailproc.Email5xx) as cm:
+                dispatcher.dispatch(make_efile(msgid=msgid))
+        self.assertEqual(cm.exception.handler, 'has_message_delivery_status')
+        self.assertEqual(
+            dict(dispatcher.handlers_count),
+            {'has_message_delivery_status': 2})
+
+    def test_unknown(self):
+        dispatcher = mailproc.HandlerDispatcher()
+        efile = mailproc.EmailFile(
+            'unknown.eml', os.stat(__file__), mailproc.MailParser().parsebytes(
+                b'Return-Path: <MAILER-DAEMON>\nSubject: Hi\n\nHello\n'))
+        with self.assertRaises(mailproc.EmailNotParsed):
+            dispatcher.dispatch(efile)
+        self.assertEqual(
+            list(dispatcher.unknown.values()), [['unknown.eml']])
+
+
+class TestInvalidAddressCollector(TestCase):
+    def test_rollup_domains(self):
+        invalids = mailproc.InvalidAddressCollector()
+        for i, rcpt in enumerate((
+                'a@dead.example', 'b@dead.example', 'b@dead.example',
+                'c@alive.example')):
+            efile = make_efile(msgid=str(i), rcpt=rcpt)
+            efile.set_original_recipient(rcpt)
+            invalids.add(efile)
+
+        docs = [i.as_dict() for i in invalids.rollup_domains(2)]
+        self.assertEqual(len(docs), 2)
+        self.assertEqual(docs[0]['to'], 'c@alive.example')
+        self.assertEqual(docs[1]['domain'], 'dead.example')
+        self.assertEqual(docs[1]['count'], 3)
+        self.assertEqual(
+            docs[1]['recipients'], ['a@dead.example', 'b@dead.example'])
+
+        self.assertEqual(len(list(invalids.rollup_domains(0))), 3)
+
+    def test_remove(self):
+        invalids = mailproc.InvalidAddressCollector()
+        efiles = [make_efile(msgid=str(i)) for i in range(2)]
+        for efile in efiles:
+            efile.set_original_recipient('a@example.nl')
+            invalids.add(efile)
+        for efile in efiles:
+            self.assertTrue(invalids)
+            invalids.remove(efile)
+        self.assertFalse(invalids)
+
+    def test_move_all_to(self):
+        with TemporaryDirectory() as maildir:
+            for folder in ('new', '.Bad-Recipient/new'):
+                os.makedirs(os.path.join(maildir, folder))
+            invalids = mailproc.InvalidAddressCollector()
+            for i, rcpt in enumerate(('a@example.nl', 'b@example.nl')):
+                filename = os.path.join(maildir, 'new', '{}.eml'.format(i))
+                efile = make_efile(filename, msgid=str(i), rcpt=rcpt)
+                efile.set_original_recipient(rcpt)
+                invalids.add(efile)
+            # Only 1.eml exists; 0.eml was removed concurrently.
+            open(os.path.join(maildir, 'new', '1.eml'), 'w').close()
+
+            failed = invalids.move_all_to('.Bad-Recipient')
+            self.assertEqual(
+                [(os.path.basename(efile.filename), e.__class__.__name__)
+                 for efile, e in failed], [('0.eml', 'FileNotFoundError')])
+            self.assertTrue(os.path.exists(
+                os.path.join(maildir, '.Bad-Recipient/new/1.eml')))
+
+
+class TestQuarantine(TestCase):
+    def test_quarantine_email(self):
+        with TemporaryDirectory() as maildir:
+            for folder in ('new', '.Quarantine/new'):
+                os.makedirs(os.path.join(maildir, folder))
+            filename = os.path.join(maildir, 'new', '1.eml')
+            with open(filename, 'w') as fp:
+                fp.write('Subject: Hi\n\nHello\n')
+
+            try:
+                raise mailproc.EmailNotParsed('could not handle')
+            except mailproc.EmailNotParsed as e:
+                new_name = mailproc.quarantine_email(filename, e)
+
+            self.assertEqual(
+                new_name, os.path.join(maildir, '.Quarantine/new/1.eml'))
+            self.assertTrue(os.path.exists(new_name))
+            with open(os.path.join(
+                    maildir, '.Quarantine', 'errors.jsonl')) as fp:
+                record = json.loads(fp.read())
+            self.assertEqual(record['error'], 'EmailNotParsed')
+            self.assertEqual(record['filename'], filename)
+
+
+class TestRefile(TestCase):
+    def test_response_folder(self):
+        self.assertEqual(mailproc.response_folder(
+            mailproc.HopCountExceeded('x', 'a@b.nl')), '.Junk-Deleted')
+        self.assertEqual(mailproc.response_folder(
+            mailproc.IgnoreAndDropEmail('x')), '.Junk-Autoreply')
+        self.assertEqual(mailproc.response_folder(
+            mailproc.Email5xx('x', 'a@b.nl')), '.Bad-Recipient')
+        self.assertEqual(mailproc.response_folder(
+            AssertionError()), '.Quarantine')
+
+    def test_refile_email(self):
+        with TemporaryDirectory() as maildir:
+            for folder in ('.Junk-Checkme/cur', '.Bad-Recipient/cur'):
+                os.makedirs(os.path.join(maildir, folder))
+            filename = os.path.join(maildir, '.Junk-Checkme/cur/1.eml:2,S')
+            open(filename, 'w').close()
+
+            new_name = mailproc.refile_email(filename, '.Bad-Recipient')
+            self.assertEqual(new_name, os.path.join(
+                maildir, '.Bad-Recipient/cur/1.eml:2,S'))
+            self.assertTrue(os.path.exists(new_name))
+            with self.assertRaises(AssertionError):
+                mailproc.refile_email(new_name, '.Bad-Recipient')
+
+
 # vim: set ts=8 sw=4 sts=4 et ai:
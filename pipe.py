@@ -0,0 +1,75 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Classification at delivery time, one mail at a time, for use as a Postfix
+pipe(8) transport (see --pipe). The invalid recipients are spooled, and
+published in batches by --flush-spool.
+"""
+import logging
+import time
+
+from . import mailproc, sources
+from .delayed import DelayedIndex
+
+
+log = logging.getLogger('emlbounce2rmq')
+
+
+def emlbounce2pipe(data, maildir, spool, delayed_index=None):
+    """
+    Classify a single mail (read from stdin by a Postfix pipe transport)
+    and write it to the maildir only if it needs keeping. Email5xx results
+    are appended to the spool, for publishing by --flush-spool.
+    """
+    parser = mailproc.MailParser()
+    dispatcher = mailproc.HandlerDispatcher()
+    filename = '<stdin>'
+    # Failures in the result handling go to .Quarantine as well: raising
+    # would make Postfix retry, leaving another copy every time.
+    try:
+        try:
+            parsed = parser.parsebytes(data)
+            efile = mailproc.EmailFile(
+                filename, sources.MemberStat(time.time(), len(data)),
+                parsed, movable=False)
+            dispatcher.dispatch(efile)
+        except mailproc.EmailResponse as e:
+            response = e
+
+        if isinstance(response, mailproc.Email2xx):
+            log.debug(
+                '%s - %s: Dropping', filename, response.__class__.__name__)
+        elif isinstance(response, mailproc.Email299):
+            filename = mailproc.deliver_email(maildir, '.Junk-Checkme', data)
+            log.debug(
+                '%s - %s: Delivered to .Junk-Checkme',
+                filename, response.__class__.__name__)
+        elif isinstance(response, mailproc.Email4xx):
+            log.debug(
+                '%s - %s: Dropping (rcpt = %s)',
+                filename, response.__class__.__name__, response.final_rcpt)
+            if delayed_index:
+                with DelayedIndex.locked(delayed_index) as delayed:
+                    delayed.add(efile, response.final_rcpt)
+        elif isinstance(response, mailproc.Email5xx):
+            # Everything that can fail before the mail is delivered.
+            record = mailproc.BounceRecord.from_efile(efile)
+            record.filename = mailproc.deliver_email(
+                maildir, '.Bad-Recipient', data)
+            spool.append(record)
+            if delayed_index:
+                with DelayedIndex.locked(delayed_index) as delayed:
+                    delayed.resolve(record.envelope_from, response.final_rcpt)
+            log.debug(
+                '%s - %s: Delivered to .Bad-Recipient and spooled '
+                '(rcpt = %s)', record.filename, response.__class__.__name__,
+                response.final_rcpt)
+        else:
+            raise response
+    except Exception as e:
+        new_name = mailproc.deliver_email(maildir, '.Quarantine', data)
+        mailproc.write_error_record(
+            maildir, '.Quarantine', filename, new_name,
+            mailproc.error_details(e))
+        log.warning(
+            '%s - %s: Delivered to .Quarantine (%s)',
+            new_name, e.__class__.__name__, e)
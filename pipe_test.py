@@ -0,0 +1,92 @@
+import json
+import os
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from .delayed import DelayedIndex
+from .mailproc_test import make_data
+from .pipe import emlbounce2pipe
+from .spool import Spool
+
+AUTOREPLY = b'''\
+Return-Path: <MAILER-DAEMON>
+Auto-Submitted: auto-generated
+Subject: Auto reply
+Content-Type: text/plain
+
+I am away.
+'''
+
+USER_REPLY = b'''\
+Return-Path: <someone@example.nl>
+Subject: Re: Hello
+Content-Type: text/plain
+
+Thanks!
+'''
+
+DELAYED = make_data().replace(
+    b'Action: failed\nStatus: 5.1.1', b'Action: delayed\nStatus: 4.4.1')
+
+NO_ENVELOPE = make_data().replace(b'Delivered-To: noreply@example.com\n', b'')
+
+
+class TestEmlbounce2pipe(TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.maildir = self.tmpdir.name
+        self.spool = Spool(os.path.join(self.maildir, 'emlbounce2rmq.spool'))
+        self.delayed_index = os.path.join(self.maildir, 'delayed.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def pipe(self, data):
+        emlbounce2pipe(
+            data, self.maildir, self.spool, delayed_index=self.delayed_index)
+
+    def folder(self, folder):
+        path = os.path.join(self.maildir, folder, 'new')
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+    def spooled(self):
+        with self.spool.flushing() as records:
+            return [i.get_original_recipient() for i in records]
+
+    def test_2xx_dropped(self):
+        self.pipe(AUTOREPLY)
+        self.assertEqual(self.folder('.Junk-Checkme'), [])
+        self.assertEqual(self.folder('.Quarantine'), [])
+        self.assertEqual(self.spooled(), [])
+
+    def test_299_delivered(self):
+        self.pipe(USER_REPLY)
+        self.assertEqual(len(self.folder('.Junk-Checkme')), 1)
+        self.assertEqual(self.spooled(), [])
+
+    def test_4xx_recorded(self):
+        self.pipe(DELAYED)
+        index = DelayedIndex(self.delayed_index)
+        self.assertEqual(
+            list(index.entries), ['noreply@example.com a@example.nl'])
+        self.assertEqual(index.seen, {})  # <stdin> cannot be seen again
+        self.assertEqual(self.folder('.Quarantine'), [])
+
+    def test_5xx_delivered_and_spooled(self):
+        self.pipe(DELAYED)
+        self.pipe(make_data())
+        self.assertEqual(len(self.folder('.Bad-Recipient')), 1)
+        self.assertEqual(self.spooled(), ['a@example.nl'])
+        self.assertEqual(len(DelayedIndex(self.delayed_index)), 0)
+
+    def test_failure_quarantined(self):
+        self.pipe(NO_ENVELOPE)
+        self.assertEqual(self.folder('.Bad-Recipient'), [])
+        self.assertEqual(self.spooled(), [])
+        self.assertEqual(len(self.folder('.Quarantine')), 1)
+        with open(os.path.join(
+                self.maildir, '.Quarantine', 'errors.jsonl')) as fp:
+            record = json.loads(fp.read())
+        self.assertEqual(record['filename'], '<stdin>')
+        self.assertEqual(record['error'], 'TypeError')
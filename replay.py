@@ -0,0 +1,270 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Re-run the handlers over mails that were already moved into the
+.Bad-Recipient, .Junk-* and .Quarantine folders, e.g. after adding or
+fixing a handler. Reports which files would now end up elsewhere, and
+optionally moves them (--apply) and publishes the new invalid recipients
+(--publish, which requires --apply, so they're not published again on the
+next replay).
+
+Mails that were archived already (see the archive module) can be added
+with --archives. These are read through the sources module, and can only
+be reported on: archive members cannot be moved.
+"""
+import argparse
+import logging
+import os
+import sys
+import traceback
+
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from . import mailproc, sources
+from .publish import EXIT_PUBLISH_FAILED, publish_invalids
+
+
+log = logging.getLogger('emlbounce2rmq')
+
+REPLAY_FOLDERS = (
+    '.Bad-Recipient',
+    '.Junk-Checkme',
+    '.Junk-Deleted',
+    '.Quarantine',
+)
+
+_ReplayResult = namedtuple('ReplayResult', (
+    'filename old_folder new_folder response message traceback date '
+    'envelope_from recipient message_id raw_original fingerprint'))
+
+
+class ReplayResult(_ReplayResult):
+    """
+    Picklable outcome of reclassify(), usable in the DuplicateIndex. The
+    traceback is only kept for the mails that go to .Quarantine.
+    """
+    def get_original_fingerprint(self):
+        return self.fingerprint
+
+    def error_details(self):
+        "Like mailproc.error_details(), for the error record"
+        return {
+            'error': self.response, 'message': self.message,
+            'traceback': self.traceback}
+
+    def as_record(self):
+        return mailproc.BounceRecord(
+            self.filename, self.date, self.envelope_from, self.recipient)
+
+
+_worker = {}  # per-process parser and dispatcher
+
+
+def reclassify(filename, old_folder=None, stat=None, data=None):
+    """
+    Reclassify a maildir file, or an archive member if its old_folder, stat
+    and data are passed.
+    """
+    if not _worker:
+        _worker['parser'] = mailproc.MailParser()
+        _worker['dispatcher'] = mailproc.HandlerDispatcher()
+
+    if old_folder is None:
+        # MAILDIR/.Folder/{cur,new}/FILE
+        old_folder = filename.rsplit('/', 3)[-3]
+    efile = response = message_id = raw_original = fingerprint = None
+    envelope_from = recipient = None
+    try:
+        if data is None:
+            with open(filename, 'rb') as fp:
+                stat = os.fstat(fp.fileno())
+                data = fp.read()
+        message_id, raw_original = mailproc.get_raw_fingerprints(data)
+        parsed = _worker['parser'].parsebytes(data)
+        efile = mailproc.EmailFile(filename, stat, parsed)
+        fingerprint = efile.get_original_fingerprint()
+        _worker['dispatcher'].dispatch(efile)
+    except Exception as e:
+        response = e
+        if isinstance(e, mailproc.Email5xx):
+            try:
+                envelope_from = efile.get_original_envelope_from()
+                recipient = e.final_rcpt
+            except Exception as e2:
+                response = e2
+
+    new_folder = mailproc.response_folder(response)
+    traceback_text = None
+    if new_folder == '.Quarantine':
+        traceback_text = mailproc.error_details(response)['traceback']
+    return ReplayResult(
+        filename, old_folder, new_folder, response.__class__.__name__,
+        str(response), traceback_text, efile.get_date() if efile else None,
+        envelope_from, recipient, message_id, raw_original, fingerprint)
+
+
+def find_files(maildir, folders):
+    filenames = []
+    for folder in folders:
+        for subdir in ('cur', 'new'):
+            path = os.path.join(maildir, folder, subdir)
+            try:
+                names = os.listdir(path)
+            except FileNotFoundError:
+                continue
+            filenames.extend(
+                os.path.join(path, name) for name in names
+                if not name.startswith('.'))
+    return filenames
+
+
+def reclassify_archive(archive):
+    """
+    Reclassify the messages in an archive, which is named
+    ARCHIVE_DIR/Folder/YYYY/YYYY-MM-DD.tar.gz. Only the path is sent to the
+    worker, and the messages are read one at a time.
+    """
+    old_folder = '.' + archive.rsplit('/', 3)[-3]
+    results = []
+    for message in sources.iter_messages([archive]):
+        if message.error:
+            log.error(
+                '%s - %s: Skipping (%s)', message.filename,
+                message.error.__class__.__name__, message.error)
+            continue
+        results.append(reclassify(
+            message.filename, old_folder, message.stat, message.fp.read()))
+    return results
+
+
+def replay(maildir, folders=REPLAY_FOLDERS, jobs=None, do_move=False,
+           do_publish=False, rollup_domains=0, archives=()):
+    """
+    Reclassify the files (and the messages in the archives) in parallel.
+    Returns the results whose folder changed, and those of them that were
+    not moved because their publish failed.
+    """
+    if archives and do_move:
+        raise ValueError('archived messages cannot be moved')
+    if do_publish and not do_move:
+        raise ValueError('publishing requires moving')
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        file_results = executor.map(
+            reclassify, find_files(maildir, folders), chunksize=64)
+        archive_results = executor.map(reclassify_archive, archives)
+        results = list(file_results)
+        for member_results in archive_results:
+            results.extend(member_results)
+
+    # Duplicates can only be found in order, so that's done here. Maildir
+    # names start with the delivery time; archive members keep theirs.
+    results.sort(key=(
+        lambda x: os.path.basename(x.filename.split('!')[-1])))
+    dedup = mailproc.DuplicateIndex()
+    changed = []
+    for result in results:
+        try:
+            dedup.skip_fingerprints(
+                result.filename, result.message_id, result.raw_original)
+            if result.recipient and dedup.is_duplicate_recipient(
+                    result, result.recipient):
+                raise mailproc.DuplicateEmail(result.filename)
+        except mailproc.DuplicateEmail as e:
+            result = result._replace(
+                new_folder=mailproc.response_folder(e),
+                response=e.__class__.__name__, message=str(e),
+                traceback=None)
+        if result.new_folder != result.old_folder:
+            changed.append(result)
+            log.info(
+                '%s: %s => %s (%s)', result.filename, result.old_folder,
+                result.new_folder, result.response)
+
+    counts = Counter((i.old_folder, i.new_folder) for i in changed)
+    for (old_folder, new_folder), count in sorted(counts.items()):
+        log.warning(
+            'Summary of replay: %s => %s: %d', old_folder, new_folder, count)
+    log.warning(
+        'Summary of replay: %d of %d files changed',
+        len(changed), len(results))
+
+    invalids = mailproc.InvalidAddressCollector()
+    for result in changed:
+        if result.new_folder == '.Bad-Recipient':
+            invalids.add(result.as_record())
+    failed = []
+    if invalids:
+        failed = publish_invalids(invalids, do_publish, rollup_domains)
+    # Unpublished files stay where they are, for the next replay.
+    failed_filenames = set(record.filename for record in failed)
+    unpublished = [i for i in changed if i.filename in failed_filenames]
+    if unpublished:
+        log.error(
+            'Summary of replay: %d files not moved, publishing failed',
+            len(unpublished))
+
+    if do_move:
+        for result in changed:
+            if result.filename in failed_filenames:
+                continue
+            new_name = mailproc.refile_email(
+                result.filename, result.new_folder)
+            if result.new_folder == '.Quarantine':
+                mailproc.write_error_record(
+                    maildir, '.Quarantine', result.filename, new_name,
+                    result.error_details())
+
+    return changed, unpublished
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Reclassify mails in the processed maildir folders with the current '
+        'handlers, in parallel, and report the ones that changed.'))
+    parser.add_argument('-v', '--verbose', action='store_true', help=(
+        'Verbose mode; list every changed file.'))
+    parser.add_argument('--folders', nargs='+', default=REPLAY_FOLDERS, help=(
+        'Folders to reclassify (default: {}).'.format(
+            ' '.join(REPLAY_FOLDERS))))
+    parser.add_argument('-j', '--jobs', type=int, help=(
+        'Number of worker processes (default: number of CPUs).'))
+    parser.add_argument('--apply', action='store_true', help=(
+        'Move the changed files to their new folder.'))
+    parser.add_argument('--publish', action='store_true', help=(
+        'Publish the files that became invalid-destination to RabbitMQ. '
+        'Requires --apply.'))
+    parser.add_argument('--archives', nargs='+', default=(), help=(
+        'Also reclassify the messages in these archives (see the archive '
+        'module), e.g. ARCHIVE_DIR/Junk-Deleted/2020/*.tar.gz. Report '
+        'only; cannot be combined with --apply.'))
+    parser.add_argument(
+        '--rollup-domains', type=int, default=0, metavar='N', help=(
+            'See emlbounce2rmq --help.'))
+    parser.add_argument('maildir', help=(
+        'Maildir root, holding the .Bad-Recipient etc. folders.'))
+    args = parser.parse_args()
+    if args.publish and not args.apply:
+        parser.error('--publish requires --apply')
+    if args.archives and args.apply:
+        parser.error('--archives cannot be combined with --apply')
+
+    logging.basicConfig(
+        format='%(asctime)-15s: %(levelname)s: %(message)s',
+        level=('INFO' if args.verbose else 'WARNING'))
+
+    changed, unpublished = replay(
+        args.maildir, folders=args.folders, jobs=args.jobs,
+        do_move=args.apply, do_publish=args.publish,
+        rollup_domains=args.rollup_domains, archives=args.archives)
+    if unpublished:
+        return EXIT_PUBLISH_FAILED
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception:
+        traceback.print_exc()
+        sys.exit(255)
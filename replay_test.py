@@ -0,0 +1,140 @@
+import io
+import json
+import os
+import sys
+import tarfile
+
+from contextlib import redirect_stderr
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+
+from .mailproc_test import make_data
+
+try:
+    from . import replay
+except ImportError:  # needs pika and a settings.py
+    replay = None
+
+# Fails on the missing envelope-from (TypeError), see pipe_test.
+NO_ENVELOPE = make_data('bounce-2', 'b@example.nl', 'original-2').replace(
+    b'Delivered-To: noreply@example.com\n', b'')
+
+
+def write_mail(maildir, folder, name, data):
+    path = os.path.join(maildir, folder, 'new')
+    os.makedirs(path, exist_ok=True)
+    filename = os.path.join(path, name)
+    with open(filename, 'wb') as fp:
+        fp.write(data)
+    return filename
+
+
+def write_archive(archive_dir, folder, members):
+    path = os.path.join(archive_dir, folder, '2020')
+    os.makedirs(path)
+    archive = os.path.join(path, '2020-01-02.tar.gz')
+    with tarfile.open(archive, 'w:gz') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return archive
+
+
+@skipIf(replay is None, 'requires pika and settings.py')
+class TestReclassify(TestCase):
+    def test_5xx(self):
+        with TemporaryDirectory() as maildir:
+            filename = write_mail(
+                maildir, '.Junk-Checkme', '1.mx', make_data())
+            result = replay.reclassify(filename)
+        self.assertEqual(result.old_folder, '.Junk-Checkme')
+        self.assertEqual(result.new_folder, '.Bad-Recipient')
+        self.assertEqual(result.response, 'Email5xx')
+        self.assertEqual(result.recipient, 'a@example.nl')
+        self.assertEqual(result.message_id, '<bounce-1>')
+        self.assertIsNone(result.traceback)
+
+    def test_failure(self):
+        with TemporaryDirectory() as maildir:
+            filename = write_mail(
+                maildir, '.Bad-Recipient', '1.mx', NO_ENVELOPE)
+            result = replay.reclassify(filename)
+        self.assertEqual(result.new_folder, '.Quarantine')
+        self.assertEqual(result.response, 'TypeError')
+        self.assertTrue(result.message)
+        self.assertIn('TypeError', result.traceback)
+
+    def test_archive_member(self):
+        result = replay.reclassify(
+            '/archive/Junk-Deleted/2020/2020-01-02.tar.gz!1.mx',
+            '.Junk-Deleted', os.stat(__file__), make_data())
+        self.assertEqual(result.old_folder, '.Junk-Deleted')
+        self.assertEqual(result.new_folder, '.Bad-Recipient')
+
+
+@skipIf(replay is None, 'requires pika and settings.py')
+class TestReplay(TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.maildir = os.path.join(self.tmpdir.name, 'maildir')
+        self.archive_dir = os.path.join(self.tmpdir.name, 'archive')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def replay(self, **kwargs):
+        with self.assertLogs('emlbounce2rmq', 'WARNING'):
+            changed, unpublished = replay.replay(
+                self.maildir, jobs=1, **kwargs)
+        self.assertEqual(unpublished, [])
+        return [
+            (os.path.basename(i.filename), i.old_folder, i.new_folder)
+            for i in changed]
+
+    def test_dedup_order(self):
+        # The same bounce, twice: the later one is the duplicate, whatever
+        # the folder or archive it is in.
+        write_mail(self.maildir, '.Junk-Deleted', '3.mx', make_data())
+        write_mail(self.maildir, '.Junk-Checkme', '1.mx', make_data())
+        archive = write_archive(
+            self.archive_dir, 'Junk-Deleted', [('2.mx', make_data())])
+        self.assertEqual(self.replay(archives=[archive]), [
+            ('1.mx', '.Junk-Checkme', '.Bad-Recipient')])
+
+    def test_apply(self):
+        write_mail(self.maildir, '.Junk-Checkme', '1.mx', make_data())
+        write_mail(self.maildir, '.Bad-Recipient', '2.mx', NO_ENVELOPE)
+        os.makedirs(os.path.join(self.maildir, '.Quarantine', 'new'))
+        self.assertEqual(self.replay(do_move=True), [
+            ('1.mx', '.Junk-Checkme', '.Bad-Recipient'),
+            ('2.mx', '.Bad-Recipient', '.Quarantine')])
+
+        quarantined = os.path.join(self.maildir, '.Quarantine', 'new', '2.mx')
+        self.assertTrue(os.path.exists(quarantined))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.maildir, '.Bad-Recipient', 'new', '1.mx')))
+        with open(os.path.join(
+                self.maildir, '.Quarantine', 'errors.jsonl')) as fp:
+            record = json.loads(fp.read())
+        self.assertEqual(record['new_filename'], quarantined)
+        self.assertEqual(record['error'], 'TypeError')
+        self.assertTrue(record['message'])
+        self.assertIn('TypeError', record['traceback'])
+
+    def test_rules(self):
+        with self.assertRaises(ValueError):
+            replay.replay(self.maildir, do_move=True, archives=['x.tar.gz'])
+        with self.assertRaises(ValueError):
+            replay.replay(self.maildir, do_publish=True)
+
+        orig_argv = sys.argv
+        try:
+            for argv in (['--publish'], ['--apply', '--archives', 'x.tgz']):
+                sys.argv = ['replay'] + argv + [self.maildir]
+                with self.assertRaises(SystemExit) as cm, \
+                        redirect_stderr(io.StringIO()):
+                    replay.main()
+                self.assertEqual(cm.exception.code, 2)
+        finally:
+            sys.argv = orig_argv
@@ -0,0 +1,123 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Message sources: maildir files, but also mbox files and tar/zip archives,
+so history can be reprocessed without unpacking it first.
+
+Every source yields SourceMessage tuples. Messages from mbox files and
+archives get a synthetic "ARCHIVE!MEMBER" filename and are not movable.
+A file that cannot be opened or read (completely) yields a SourceMessage
+with the error set, after the messages that could be read.
+"""
+import calendar
+import io
+import mailbox
+import os
+import tarfile
+import time
+import zipfile
+
+from collections import namedtuple
+
+try:
+    import zstandard  # python3-zstandard, optional
+except ImportError:
+    zstandard = None
+
+
+SourceMessage = namedtuple(
+    'SourceMessage', 'filename stat fp movable error', defaults=(None,))
+
+# Stand-in for os.stat_result, for EmailFile.get_date().
+MemberStat = namedtuple('MemberStat', 'st_mtime st_size')
+
+
+def member_filename(archive, member):
+    return '{}!{}'.format(archive, member)
+
+
+def maildir_messages(filename):
+    with open(filename, 'rb') as fp:
+        yield SourceMessage(filename, os.fstat(fp.fileno()), fp, True)
+
+
+def mbox_messages(filename):
+    default_mtime = os.stat(filename).st_mtime
+    mbox = mailbox.mbox(filename, create=False)
+    try:
+        for key in mbox.iterkeys():
+            with mbox.get_file(key, from_=True) as fp:
+                from_ = fp.readline().decode('ascii', 'replace').split()
+                try:
+                    # From MAILER-DAEMON Thu Jan  2 12:00:00 2020
+                    mtime = calendar.timegm(time.strptime(
+                        ' '.join(from_[-5:]), '%a %b %d %H:%M:%S %Y'))
+                except ValueError:
+                    mtime = default_mtime
+                yield SourceMessage(
+                    member_filename(filename, key),
+                    MemberStat(mtime, None), fp, False)
+    finally:
+        mbox.close()
+
+
+def tar_messages(filename):
+    with open(filename, 'rb') as rawfp:
+        if filename.endswith(('.tar.zst', '.tzst')):
+            if zstandard is None:
+                raise ImportError(
+                    'reading {} requires zstandard'.format(filename))
+            stream = zstandard.ZstdDecompressor().stream_reader(rawfp)
+        else:
+            stream = rawfp
+
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # Streamed members are not seekable; the parser wants that.
+                with tar.extractfile(member) as fp:
+                    data = io.BytesIO(fp.read())
+                yield SourceMessage(
+                    member_filename(filename, member.name),
+                    MemberStat(member.mtime, member.size), data, False)
+
+
+def zip_messages(filename):
+    with zipfile.ZipFile(filename) as zip_:
+        for info in zip_.infolist():
+            if info.is_dir():
+                continue
+            mtime = calendar.timegm(info.date_time)
+            with zip_.open(info) as fp:
+                yield SourceMessage(
+                    member_filename(filename, info.filename),
+                    MemberStat(mtime, info.file_size), fp, False)
+
+
+SOURCES = (
+    (('.mbox', '/mbox'), mbox_messages),
+    (('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar.zst', '.tzst'),
+     tar_messages),
+    (('.zip',), zip_messages),
+)
+
+
+def iter_messages(filenames):
+    """
+    Yields SourceMessages for all filenames, picking the source by suffix.
+    The fp is only valid until the next message is requested. Errors are
+    not raised, but yielded in the error field, so the caller can handle
+    them per file.
+    """
+    for filename in filenames:
+        for suffixes, source in SOURCES:
+            if filename.endswith(suffixes):
+                break
+        else:
+            source = maildir_messages
+        try:
+            yield from source(filename)
+        except Exception as e:
+            movable = (
+                source is maildir_messages and os.path.exists(filename))
+            yield SourceMessage(filename, None, None, movable, e)
@@ -0,0 +1,41 @@
+import io
+import os
+import tarfile
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from . import sources
+
+
+class TestIterMessages(TestCase):
+    def test_errors_per_file(self):
+        with TemporaryDirectory() as tmpdir:
+            archive_path = os.path.join(tmpdir, 'bounces.tar.gz')
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+                for name in ('1.eml', '2.eml'):
+                    data = os.urandom(20000)  # incompressible
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            with open(archive_path, 'wb') as fp:
+                fp.write(buf.getvalue()[:-10000])  # truncated in 2.eml
+            mail_path = os.path.join(tmpdir, '3.eml')
+            with open(mail_path, 'wb') as fp:
+                fp.write(b'Subject: Hi\n\nHello\n')
+            missing_path = os.path.join(tmpdir, 'missing.eml')
+
+            messages = [
+                (message.filename, message.movable,
+                 message.error.__class__.__name__ if message.error else None)
+                for message in sources.iter_messages(
+                    [missing_path, archive_path, mail_path])]
+
+        self.assertEqual(messages[0], (
+            missing_path, False, 'FileNotFoundError'))
+        self.assertEqual(messages[1], (
+            archive_path + '!1.eml', False, None))
+        self.assertEqual(messages[-2][0:2], (archive_path, False))
+        self.assertIsNotNone(messages[-2][2])
+        self.assertEqual(messages[-1], (mail_path, True, None))
@@ -0,0 +1,48 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Spool of Email5xx results, written by the pipe mode one mail at a time and
+read back in a batch (see --flush-spool) for publishing.
+"""
+import json
+import os
+
+from contextlib import contextmanager
+
+from .locking import locked
+from .mailproc import BounceRecord
+
+
+class Spool:
+    def __init__(self, path):
+        self.path = path
+        self.flushing_path = path + '.flushing'
+
+    def append(self, efile):
+        line = json.dumps(BounceRecord.from_efile(efile).as_dict()) + '\n'
+        with locked(self.path):
+            with open(self.path, 'a') as fp:
+                fp.write(line)
+
+    @contextmanager
+    def flushing(self):
+        """
+        Yields the spooled BounceRecords. They are removed from the spool
+        only if the with-block completes; if not, they are yielded again
+        on the next flush.
+        """
+        with locked(self.path):
+            if (not os.path.exists(self.flushing_path) and
+                    os.path.exists(self.path)):
+                os.rename(self.path, self.flushing_path)
+
+        records = []
+        if os.path.exists(self.flushing_path):
+            with open(self.flushing_path) as fp:
+                records = [
+                    BounceRecord.from_dict(json.loads(line))
+                    for line in fp if line.strip()]
+
+        yield records
+
+        if os.path.exists(self.flushing_path):
+            os.unlink(self.flushing_path)
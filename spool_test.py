@@ -0,0 +1,58 @@
+import os
+
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from .mailproc import BounceRecord
+from .spool import Spool
+
+
+def make_record(recipient):
+    return BounceRecord(
+        '/maildir/.Bad-Recipient/new/1577966400.M1P2.mx',
+        datetime(2020, 1, 2, 12, 0), 'noreply@example.com', recipient)
+
+
+class TestSpool(TestCase):
+    def test_append_and_flush(self):
+        with TemporaryDirectory() as tmpdir:
+            spool = Spool(os.path.join(tmpdir, 'spool.jsonl'))
+            spool.append(make_record('a@example.nl'))
+            spool.append(make_record('b@example.nl'))
+
+            with spool.flushing() as records:
+                self.assertEqual(
+                    [i.as_dict() for i in records],
+                    [make_record('a@example.nl').as_dict(),
+                     make_record('b@example.nl').as_dict()])
+                # Appends during the flush are kept for the next one.
+                spool.append(make_record('c@example.nl'))
+
+            with spool.flushing() as records:
+                self.assertEqual(
+                    [i.get_original_recipient() for i in records],
+                    ['c@example.nl'])
+            with spool.flushing() as records:
+                self.assertEqual(records, [])
+
+    def test_failed_flush_keeps_records(self):
+        with TemporaryDirectory() as tmpdir:
+            spool = Spool(os.path.join(tmpdir, 'spool.jsonl'))
+            spool.append(make_record('a@example.nl'))
+
+            with self.assertRaises(ValueError):
+                with spool.flushing() as records:
+                    self.assertEqual(len(records), 1)
+                    raise ValueError('publish failed')
+
+            spool.append(make_record('b@example.nl'))
+            with spool.flushing() as records:
+                self.assertEqual(
+                    [i.get_original_recipient() for i in records],
+                    ['a@example.nl'])
+            # The records appended in the meantime follow on the next flush.
+            with spool.flushing() as records:
+                self.assertEqual(
+                    [i.get_original_recipient() for i in records],
+                    ['b@example.nl'])
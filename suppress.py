@@ -0,0 +1,147 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Suppression table of invalid recipients, so outbound mail can skip
+recipients that hard-bounced before.
+
+The table is a cdb (constant database) file, so any cdb library can read
+it, and lookups are O(1) through mmap. Keys are "from to" (lowercase),
+values the last_seen date (YYYY-MM-DD). It is replaced atomically.
+"""
+import mmap
+import os
+import struct
+
+from datetime import datetime, timedelta
+
+from .locking import locked
+
+
+def cdb_hash(key):
+    h = 5381
+    for c in key:
+        h = (((h << 5) + h) & 0xffffffff) ^ c
+    return h
+
+
+def write_cdb(path, items):
+    "Write (key, value) bytes pairs to path, atomically"
+    tables = [[] for i in range(256)]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(b'\0' * 2048)
+        pos = 2048
+        for key, value in items:
+            fp.write(struct.pack('<II', len(key), len(value)))
+            fp.write(key)
+            fp.write(value)
+            h = cdb_hash(key)
+            tables[h & 0xff].append((h, pos))
+            pos += 8 + len(key) + len(value)
+
+        header = []
+        for entries in tables:
+            slots = [(0, 0)] * (len(entries) * 2)
+            for h, record_pos in entries:
+                slot = (h >> 8) % len(slots)
+                while slots[slot][1]:
+                    slot = (slot + 1) % len(slots)
+                slots[slot] = (h, record_pos)
+            header.append((pos, len(slots)))
+            for h, record_pos in slots:
+                fp.write(struct.pack('<II', h, record_pos))
+            pos += 8 * len(slots)
+
+        fp.seek(0)
+        for table_pos, table_len in header:
+            fp.write(struct.pack('<II', table_pos, table_len))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp_path, path)
+
+
+class CdbReader:
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, key, default=None):
+        h = cdb_hash(key)
+        table_pos, table_len = struct.unpack_from(
+            '<II', self._map, (h & 0xff) * 8)
+        if not table_len:
+            return default
+        slot = (h >> 8) % table_len
+        for i in range(table_len):
+            slot_hash, record_pos = struct.unpack_from(
+                '<II', self._map, table_pos + slot * 8)
+            if not record_pos:
+                break
+            if slot_hash == h:
+                klen, vlen = struct.unpack_from('<II', self._map, record_pos)
+                key_pos = record_pos + 8
+                if self._map[key_pos:key_pos + klen] == key:
+                    return self._map[key_pos + klen:key_pos + klen + vlen]
+            slot = (slot + 1) % table_len
+        return default
+
+    def items(self):
+        # The records run from the header up to the first hash table.
+        end, = struct.unpack_from('<I', self._map, 0)
+        pos = 2048
+        while pos < end:
+            klen, vlen = struct.unpack_from('<II', self._map, pos)
+            key_pos = pos + 8
+            yield (
+                self._map[key_pos:key_pos + klen],
+                self._map[key_pos + klen:key_pos + klen + vlen])
+            pos = key_pos + klen + vlen
+
+
+def suppression_key(envelope_from, recipient):
+    return '{} {}'.format(envelope_from, recipient).lower().encode('utf-8')
+
+
+def is_suppressed(path, envelope_from, recipient):
+    "Convenience lookup; keep a CdbReader open for many lookups"
+    with CdbReader(path) as cdb:
+        return cdb.get(suppression_key(envelope_from, recipient)) is not None
+
+
+def update_table(path, invalids, expire_days=180, now=None):
+    """
+    Merge the InvalidAddressLists from invalids into the table at path,
+    dropping entries not seen for expire_days days. Call it also when
+    there are no invalids, so old entries expire.
+
+    Concurrent updates (a batch run and --flush-spool) are serialized by
+    a lock, so neither loses the entries of the other.
+    """
+    now = now or datetime.utcnow()
+    expire = (now - timedelta(days=expire_days)).strftime('%Y-%m-%d')
+    with locked(path):
+        table = {}
+        if os.path.exists(path):
+            with CdbReader(path) as cdb:
+                table = dict(
+                    (key, value.decode('ascii'))
+                    for key, value in cdb.items())
+
+        for invalid in invalids:
+            doc = invalid.as_dict()
+            key = suppression_key(doc['from'], doc['to'])
+            table[key] = max(table.get(key, ''), doc['last_seen'])
+
+        items = sorted(
+            (key, last_seen.encode('ascii'))
+            for key, last_seen in table.items() if last_seen >= expire)
+        write_cdb(path, items)
+    return len(items)
@@ -0,0 +1,96 @@
+import os
+
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+
+from . import suppress
+from .locking import locked
+
+
+class TestCdb(TestCase):
+    def test_roundtrip(self):
+        items = [
+            ('key{}'.format(i).encode(), 'value{}'.format(i).encode())
+            for i in range(1000)]
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.cdb')
+            suppress.write_cdb(path, items)
+            with suppress.CdbReader(path) as cdb:
+                for key, value in items:
+                    self.assertEqual(cdb.get(key), value)
+                self.assertIsNone(cdb.get(b'key1000'))
+                self.assertEqual(list(cdb.items()), items)
+
+    def test_empty(self):
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.cdb')
+            suppress.write_cdb(path, [])
+            with suppress.CdbReader(path) as cdb:
+                self.assertIsNone(cdb.get(b'key'))
+                self.assertEqual(list(cdb.items()), [])
+
+
+class FakeInvalid:
+    def __init__(self, from_, to, last_seen):
+        self.doc = {'from': from_, 'to': to, 'last_seen': last_seen}
+
+    def as_dict(self):
+        return self.doc
+
+
+class TestUpdateTable(TestCase):
+    def test_merge_and_expire(self):
+        now = datetime(2020, 7, 1)
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'suppress.cdb')
+            suppress.update_table(path, [
+                FakeInvalid('noreply@example.com', 'Old@example.nl',
+                            '2019-01-01'),
+                FakeInvalid('noreply@example.com', 'a@example.nl',
+                            '2020-06-01'),
+            ], now=now)
+            count = suppress.update_table(path, [
+                FakeInvalid('noreply@example.com', 'b@example.nl',
+                            '2020-06-30'),
+            ], now=now)
+
+            self.assertEqual(count, 2)
+            self.assertTrue(suppress.is_suppressed(
+                path, 'noreply@example.com', 'A@example.nl'))
+            self.assertTrue(suppress.is_suppressed(
+                path, 'noreply@example.com', 'b@example.nl'))
+            self.assertFalse(suppress.is_suppressed(
+                path, 'noreply@example.com', 'old@example.nl'))
+            self.assertFalse(suppress.is_suppressed(
+                path, 'other@example.com', 'a@example.nl'))
+
+    def test_expire_without_invalids(self):
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'suppress.cdb')
+            suppress.update_table(path, [
+                FakeInvalid('noreply@example.com', 'a@example.nl',
+                            '2020-01-01'),
+            ], now=datetime(2020, 1, 2))
+            self.assertEqual(
+                suppress.update_table(path, [], now=datetime(2020, 7, 1)), 0)
+
+    def test_update_waits_for_lock(self):
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'suppress.cdb')
+            thread = Thread(target=suppress.update_table, args=(path, [
+                FakeInvalid('noreply@example.com', 'a@example.nl',
+                            '2020-06-30'),
+            ]), kwargs={'now': datetime(2020, 7, 1)})
+            with locked(path):
+                thread.start()
+                thread.join(0.2)
+                self.assertTrue(thread.is_alive())
+                self.assertFalse(os.path.exists(path))
+            thread.join()
+            self.assertTrue(suppress.is_suppressed(
+                path, 'noreply@example.com', 'a@example.nl'))
+
+
+# vim: set ts=8 sw=4 sts=4 et ai:
@@ -0,0 +1,75 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+"""
+Per-file JSON-lines trace of the processing stages, with sampling and a
+"slowest N files" report.
+"""
+import heapq
+import json
+import random
+import time
+
+
+class Trace:
+    def __init__(self, filename, sampled):
+        self.record = {'path': filename}
+        self.sampled = sampled
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, stage):
+        "Record the time since the previous lap as <stage>_ms"
+        now = time.perf_counter()
+        self.record[stage + '_ms'] = round((now - self._last) * 1000, 3)
+        self._last = now
+
+    def total_ms(self):
+        "The time since the start, also when the last stage did not lap"
+        return round((time.perf_counter() - self._start) * 1000, 3)
+
+
+class TraceLog:
+    """
+    Writes one JSON record per file to fp, for a sample of the files, and
+    for all files slower than slow_ms. Keeps the slowest N files for
+    report(), whether they were sampled or not.
+    """
+    def __init__(self, fp=None, sample=1.0, slow_ms=None, slowest=10):
+        self.fp = fp
+        self.sample = sample
+        self.slow_ms = slow_ms
+        self.slowest = slowest
+        self._slowest_heap = []
+        self._seq = 0
+
+    def start(self, filename):
+        sampled = bool(self.fp) and (
+            self.sample >= 1.0 or random.random() < self.sample)
+        return Trace(filename, sampled)
+
+    def finish(self, trace, size, efile, response):
+        trace.record['size'] = size
+        trace.record['total_ms'] = total_ms = trace.total_ms()
+        trace.record['handler'] = getattr(response, 'handler', None)
+        trace.record['exception'] = (
+            response.__class__.__name__ if response else None)
+        trace.record['recipient'] = getattr(response, 'final_rcpt', None)
+
+        if self.slowest:
+            self._seq += 1  # tie breaker, records do not compare
+            item = (total_ms, self._seq, trace.record)
+            if len(self._slowest_heap) < self.slowest:
+                heapq.heappush(self._slowest_heap, item)
+            else:
+                heapq.heappushpop(self._slowest_heap, item)
+
+        if self.fp and (trace.sampled or (
+                self.slow_ms is not None and total_ms >= self.slow_ms)):
+            # Counting the parts walks the mail; only do it when writing.
+            trace.record['parts'] = (
+                sum(1 for i in efile.email.walk()) if efile else None)
+            self.fp.write(json.dumps(trace.record) + '\n')
+
+    def report(self):
+        "Returns the records of the slowest files, slowest first"
+        return [
+            record for total_ms, seq, record in sorted(
+                self._slowest_heap, reverse=True)]
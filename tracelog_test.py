@@ -0,0 +1,69 @@
+import io
+import json
+
+from unittest import TestCase
+
+from .tracelog import TraceLog
+
+
+def finish(tracelog, filename, ms, response=None):
+    "Finish a trace of filename that took ms milliseconds"
+    trace = tracelog.start(filename)
+    trace._start -= ms / 1000
+    tracelog.finish(trace, 100, None, response)
+    return trace
+
+
+def written(fp):
+    return [json.loads(line)['path'] for line in fp.getvalue().splitlines()]
+
+
+class TestTraceLog(TestCase):
+    def test_sample(self):
+        fp = io.StringIO()
+        tracelog = TraceLog(fp, sample=1.0)
+        finish(tracelog, '1.eml', 1)
+        self.assertEqual(written(fp), ['1.eml'])
+
+        fp = io.StringIO()
+        tracelog = TraceLog(fp, sample=0.0)
+        finish(tracelog, '1.eml', 1)
+        self.assertEqual(written(fp), [])
+
+    def test_slow_ms(self):
+        fp = io.StringIO()
+        tracelog = TraceLog(fp, sample=0.0, slow_ms=500)
+        finish(tracelog, 'fast.eml', 1)
+        finish(tracelog, 'slow.eml', 600)
+        self.assertEqual(written(fp), ['slow.eml'])
+
+    def test_slowest(self):
+        tracelog = TraceLog(slowest=2)
+        for filename, ms in (
+                ('1.eml', 30), ('2.eml', 10), ('3.eml', 50), ('4.eml', 20)):
+            finish(tracelog, filename, ms)
+        self.assertEqual(
+            [record['path'] for record in tracelog.report()],
+            ['3.eml', '1.eml'])
+
+    def test_failure_timing(self):
+        # A handler that takes 300 ms and then raises: no classify lap.
+        tracelog = TraceLog(slowest=1)
+        trace = tracelog.start('1.eml')
+        trace.lap('read')
+        trace._start -= 0.3
+        trace._last -= 0.3
+        trace.lap('failed')
+        tracelog.finish(trace, 100, None, ValueError('odd mail'))
+
+        record, = tracelog.report()
+        self.assertGreaterEqual(record['failed_ms'], 300)
+        self.assertGreaterEqual(record['total_ms'], 300)
+        self.assertEqual(record['exception'], 'ValueError')
+        self.assertNotIn('classify_ms', record)
+
+        # Also without the final lap, the total runs up to finish().
+        trace = tracelog.start('2.eml')
+        trace._start -= 0.4
+        tracelog.finish(trace, 100, None, ValueError('odd mail'))
+        self.assertEqual(tracelog.report()[0]['path'], '2.eml')